@@ -0,0 +1,449 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""The asyncio engine, selected with ``--engine asyncio``.
+
+An Engine runs one event loop in a thread of its own.   AsyncBitbucket,
+AsyncGitHub and resolve_users() are the async counterparts of Bitbucket,
+GitHub and the user lookups; they send their requests with aiohttp from
+coroutines on that loop, so many of them can be waiting on the network
+at once without a thread each.   The rest of the migration stays in
+threads, and hands coroutines to the loop with Engine.submit(), which
+returns a concurrent.futures.Future.
+
+Calls to GitHub go through the same RateLimiter as the GitHub client's
+own, so the limit is shared however the calls are made.
+
+"""
+
+import asyncio
+import datetime
+import json
+import requests
+import threading
+import time
+import types
+import warnings
+
+from . import base
+from . import convert
+from .bitbucket import USER_URL
+from .github import GitHub
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class Engine:
+    def __init__(self, options):
+        if aiohttp is None:
+            raise RuntimeError(
+                "The asyncio engine requires aiohttp, which can be "
+                "installed with: pip install aiohttp")
+        self.options = options
+        self.sessions = []
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop and return a future for it."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Run a coroutine on the loop and wait for its result."""
+        return self.submit(coro).result()
+
+    def session(
+            self, auth=None, headers=None, hooks=(), retries=0,
+            pool_size=None):
+        """Return a Session, which opens up to pool_size connections at a
+        time, --http-pool-size by default."""
+        session = Session(
+            auth, headers, hooks, retries,
+            pool_size or self.options.http_pool_size)
+        self.sessions.append(session)
+        return session
+
+    def close(self):
+        """Cancel whatever is still running, and stop the loop."""
+        self.run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _close(self):
+        tasks = [
+            task for task in asyncio.all_tasks()
+            if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for session in self.sessions:
+            await session.close()
+
+
+class Response:
+    """The parts of a ``requests`` response the clients and hooks use."""
+
+    def __init__(self, method, url, status, headers, content, elapsed):
+        self.request = types.SimpleNamespace(method=method, url=url)
+        self.status_code = status
+        self.headers = headers
+        self.content = content
+        self.elapsed = datetime.timedelta(seconds=elapsed)
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def links(self):
+        links = {}
+        if "Link" in self.headers:
+            for link in requests.utils.parse_header_links(
+                    self.headers["Link"]):
+                links[link.get("rel") or link.get("url")] = link
+        return links
+
+
+class Session:
+    """An aiohttp session, created on first use from within the loop.
+
+    Each response is passed to the ``hooks`` like a ``requests`` response
+    hook.   GET and HEAD requests failing with a connection error or a
+    502/503/504 response are retried up to ``retries`` times, as in
+    base.make_session().
+
+    """
+
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, auth, headers, hooks, retries, pool_size):
+        self.auth = aiohttp.BasicAuth(*auth) if auth else None
+        self.headers = headers
+        self.hooks = list(hooks)
+        self.retries = retries
+        self.pool_size = pool_size
+        self._session = None
+
+    async def request(self, method, url, **kw):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                auth=self.auth, headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+        retries = self.retries if method in ("GET", "HEAD") else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            started = time.time()
+            try:
+                async with self._session.request(method, url, **kw) as resp:
+                    content = await resp.read()
+            except aiohttp.ClientConnectionError:
+                if attempt == retries:
+                    raise
+                continue
+            response = Response(
+                method, str(resp.url), resp.status, resp.headers, content,
+                time.time() - started)
+            if resp.status not in self.retry_statuses or \
+                    attempt == retries:
+                break
+        for hook in self.hooks:
+            hook(response)
+        return response
+
+    async def get(self, url, **kw):
+        return await self.request("GET", url, **kw)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+async def acquire(rate_limiter):
+    """Wait on the rate limiter without blocking the loop."""
+
+    started = None
+    while True:
+        wait = rate_limiter.try_acquire()
+        if wait is None:
+            if started is not None:
+                rate_limiter.record_wait(time.time() - started)
+            return
+        if started is None:
+            started = time.time()
+        await asyncio.sleep(wait)
+
+
+class AsyncBitbucket:
+    """Fetches the comments, changes and attachments of issues from the
+    Bitbucket API."""
+
+    def __init__(self, bb, engine):
+        self.bb = bb
+        self.session = engine.session(
+            auth=bb.auth,
+            hooks=[engine.options.metrics.http_hook("bitbucket")],
+            retries=engine.options.http_retries)
+
+    async def _get(self, url, warn=None):
+        return self.bb._expect_200(
+            await self.session.get(url, params={"sort": "id"}), url, warn)
+
+    async def get_issue_comments(self, issue_id):
+        next_url = "{}/{}/comments/".format(self.bb.url, issue_id)
+        comments = []
+        while next_url is not None:
+            rec = (await self._get(next_url)).json()
+            next_url = rec.get('next')
+            comments.extend(rec['values'])
+        return comments
+
+    async def get_issue_changes(self, issue_id):
+        next_url = "{}/{}/changes/".format(self.bb.url, issue_id)
+        changes = []
+        while next_url is not None:
+            respo = await self._get(next_url, warn=(500,))
+            # see Bitbucket.get_issue_changes()
+            if respo.status_code == 500:
+                warnings.warn(
+                    "Failed to get issue changes from {} due to "
+                    "semi-expected HTTP status code: {}".format(
+                        next_url, respo.status_code)
+                )
+                return []
+            rec = respo.json()
+            next_url = rec.get('next')
+            changes.extend(rec['values'])
+        return changes
+
+    async def get_attachments(self, issue_num):
+        url = "{}/{}/attachments".format(self.bb.url, issue_num)
+        respo = self.bb._expect_200(await self.session.get(url), url)
+        return respo.json()['values']
+
+    async def fetch_issue_resources(self, issue, options):
+        """Return the comments, changes and attachment list of an issue,
+        fetched concurrently."""
+
+        if isinstance(issue, base.DummyIssue):
+            return [], [], []
+
+        fetches = [
+            self.get_issue_comments(issue['id']),
+            self.get_issue_changes(issue['id']),
+        ]
+        if options.attachments_wiki or options.mention_attachments:
+            fetches.append(self.get_attachments(issue['id']))
+        results = await asyncio.gather(*fetches)
+        if len(results) == 2:
+            results.append([])
+        return tuple(results)
+
+
+def prefetch_users(bitbucket, gh, options, concurrency):
+    """Resolve every user in the export ahead of the conversion, as
+    convert.prefetch_users() does, with up to ``concurrency`` lookups
+    in flight at once."""
+
+    usernames = sorted(bitbucket.get_usernames())
+    print("prefetching {} users".format(len(usernames)))
+    options.aio.run(resolve_users(bitbucket, gh, options, usernames,
+                                  concurrency))
+
+
+async def resolve_users(bitbucket, gh, options, usernames, concurrency):
+    """Look up the Bitbucket display names and GitHub usernames of the
+    given users."""
+
+    engine = options.aio
+    bb_session = engine.session(
+        hooks=[options.metrics.http_hook("bitbucket")],
+        retries=options.http_retries)
+    gh_session = engine.session(
+        auth=options.gh_auth,
+        hooks=[
+            gh.rate_limiter.update, options.metrics.http_hook("github")],
+        pool_size=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve_bitbucket(name):
+        if name in bitbucket._user_map:
+            return
+        try:
+            user = bitbucket._cached_user(name)
+        except KeyError:
+            if options.offline:
+                user = bitbucket._fetch_user(name)
+            else:
+                url = USER_URL.format(name)
+                user = bitbucket._user_fetched(
+                    name, url, await bb_session.get(url))
+        bitbucket._user_map[name] = user
+
+    async def resolve_github(name):
+        try:
+            convert._known_gh_username(
+                name, options.users, options.user_cache, options.offline)
+            return
+        except KeyError:
+            pass
+        url = options.github_api_url + '/users/' + name
+        await acquire(gh.rate_limiter)
+        respo = await gh_session.request("HEAD", url)
+        convert._checked_gh_username(
+            name, options.users, options.user_cache, url,
+            respo.status_code)
+
+    async def resolve(name):
+        async with semaphore:
+            await resolve_bitbucket(name)
+            if name.lower() != "guest":
+                await resolve_github(name)
+
+    await asyncio.gather(*[resolve(name) for name in usernames])
+
+
+class AsyncGitHub:
+    """Pushes issues to GitHub from the event loop.
+
+    It has the same push_github_issue() and finish_imports() as GitHub,
+    for the thread pushing issues, but the import status checks run as
+    tasks on the loop, each polling its own import, so that up to
+    --import-window imports are verified concurrently.   A failed check
+    is raised from the next call.
+
+    """
+
+    def __init__(self, gh, engine):
+        self.gh = gh
+        self.engine = engine
+        self.options = gh.options
+        self.session = engine.session(
+            auth=self.options.gh_auth, headers=GitHub.headers,
+            hooks=[
+                gh.rate_limiter.update,
+                self.options.metrics.http_hook("github"),
+            ],
+            # one connection for each import in the window
+            pool_size=max(self.options.import_window, 1))
+        self.pending = {}
+        self.error = None
+        self._window = None
+        self._pending_seconds = self.options.metrics.histogram(
+            "import_pending_seconds",
+            "Time from POSTing an issue import to verifying it.")
+
+    def push_github_issue(self, issue, comments, verify_issue_id):
+        self.engine.run(self._push(issue, comments, verify_issue_id))
+
+    def finish_imports(self):
+        self.engine.run(self._drain())
+
+    async def _api_call(self, method, url, **kw):
+        # as GitHub._api_call()
+        rate_limiter = self.gh.rate_limiter
+        for attempt in range(5):
+            await acquire(rate_limiter)
+            respo = await self.session.request(method, url, **kw)
+            if not rate_limiter.is_rate_limited(respo):
+                break
+            print("Rate limited by GitHub on {}, retrying".format(url))
+        return respo
+
+    async def get_all_issues(self, workers):
+        """Yield every issue and pull request of the repository, as
+        GitHub.get_all_issues() does."""
+
+        issues, last_page = await self._get_issues_page(1)
+        for issue in issues:
+            yield issue
+
+        semaphore = asyncio.Semaphore(workers)
+
+        async def get_page(page):
+            async with semaphore:
+                return await self._get_issues_page(page)
+
+        for page in asyncio.as_completed(
+                [get_page(page) for page in range(2, last_page + 1)]):
+            issues, _ = await page
+            for issue in issues:
+                yield issue
+
+    async def _get_issues_page(self, page):
+        url, params = self.gh._issues_page_request(page)
+        respo = await self._api_call("GET", url, params=params)
+        return self.gh._issues_page(url, respo)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    async def _push(self, issue, comments, verify_issue_id):
+        if self._window is None:
+            self._window = asyncio.Semaphore(
+                max(self.options.import_window, 1))
+        self._raise_error()
+        await self._window.acquire()
+        try:
+            self._raise_error()
+            url, issue_data = self.gh._start_import(
+                issue, comments, verify_issue_id)
+            push_respo = await self._api_call("POST", url, json=issue_data)
+            status_url = self.gh._import_started(
+                issue, verify_issue_id, url, push_respo)
+        except BaseException:
+            self._window.release()
+            raise
+        self.pending[verify_issue_id] = asyncio.ensure_future(
+            self._verify(verify_issue_id, status_url))
+
+    async def _verify(self, verify_issue_id, status_url):
+        added = time.time()
+        try:
+            while True:
+                await asyncio.sleep(1)
+                respo = await self._api_call("GET", status_url)
+                if self.gh._import_checked(
+                        verify_issue_id, status_url, respo):
+                    break
+            self._pending_seconds.observe(time.time() - added)
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+        finally:
+            del self.pending[verify_issue_id]
+            self._window.release()
+
+    async def _drain(self):
+        while self.pending:
+            self._raise_error()
+            print("Still waiting for verified status on {}...".format(
+                ", ".join(str(issue_id) for issue_id in sorted(self.pending))))
+            await asyncio.wait(
+                list(self.pending.values()),
+                return_when=asyncio.FIRST_COMPLETED)
+        self._raise_error()
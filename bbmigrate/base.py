@@ -14,6 +14,10 @@
 # along with the Bitbucket issue migration script.
 # If not, see <http://www.gnu.org/licenses/>.
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 try:
     import keyring
     assert keyring.get_keyring().priority
@@ -23,6 +27,8 @@ except (ImportError, AssertionError):
     class keyring:
         get_password = staticmethod(lambda system, username: None)
 
+GITHUB_API_URL = "https://api.github.com"
+
 
 class Client:
     def _expect_200(self, response, url, warn=None):
@@ -37,6 +43,30 @@ class Client:
         return response
 
 
+def make_session(options):
+    """Return a requests session with a keep-alive connection pool.
+
+    Failed GET and HEAD calls due to connection errors or 502/503/504
+    responses are retried at the transport level, up to
+    ``options.http_retries`` times.
+
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_maxsize=options.http_pool_size,
+        max_retries=Retry(
+            total=options.http_retries,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(options.metrics.http_hook("bitbucket"))
+    return session
+
+
 class DummyIssue(dict):
     def __init__(self, num):
         self.update(
@@ -0,0 +1,422 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Throughput benchmark of the migration.
+
+A synthetic Bitbucket export is generated and migrated with
+``--dry-run --offline``, or pushed to a local stand-in for GitHub with
+``--standin``, reporting the issues converted per second, the
+time spent in each stage and the peak memory use.   Run it as::
+
+    python -m bbmigrate.bench --issues 5000 -- --mention-changes
+
+Arguments after ``--`` are passed on to the migration.
+
+"""
+
+import argparse
+import contextlib
+import datetime
+import functools
+import getpass
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import zipfile
+
+from . import aio
+from . import convert
+from . import main
+from .bitbucket import BitbucketExport
+from .github import GitHub
+from .standin import StandIn
+
+_WORDS = (
+    "the a session query engine column table mapper relationship "
+    "commit rollback flush identity map lazy load eager join "
+    "fails when with after before should returns raises error "
+    "regression python version dialect backend connection pool"
+).split()
+
+_CODE = [
+    "{{{\n#!python\nfrom sqlalchemy import create_engine\n"
+    "e = create_engine('sqlite://')\ne.execute('select 1')\n}}}",
+    "{{{\nTraceback (most recent call last):\n"
+    "  File \"test.py\", line 3, in <module>\n"
+    "ValueError: no\n}}}",
+    "    #!sql\n    SELECT * FROM table WHERE id = 5",
+]
+
+_STATUSES = ["new", "open", "resolved", "wontfix", "invalid", "duplicate"]
+
+
+def _date(rand):
+    date = datetime.datetime(2010, 1, 1) + datetime.timedelta(
+        seconds=rand.randint(0, 8 * 365 * 86400))
+    return date.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00")
+
+
+def _text(rand, size, users, repo):
+    """Return roughly size characters of issue-like markup.
+
+    Links to issues point at repo, so that they're converted.
+
+    """
+    parts = []
+    length = 0
+    while length < size:
+        choice = rand.random()
+        if choice < 0.1:
+            part = rand.choice(_CODE)
+        elif choice < 0.15:
+            part = "see issue #{} and <<cset {:012x}>>".format(
+                rand.randint(1, 5000), rand.getrandbits(48))
+        elif choice < 0.2:
+            part = "@{} https://bitbucket.org/{}/issue/{}".format(
+                rand.choice(users), repo, rand.randint(1, 5000))
+        else:
+            part = " ".join(
+                rand.choice(_WORDS) for _ in range(rand.randint(5, 30)))
+        parts.append(part)
+        length += len(part) + 2
+    return "\n\n".join(parts)
+
+
+def write_export(
+        path, issues=1000, comments=(0, 8), logs=(0, 4), attachments=(0, 2),
+        gap_rate=0.05, body_size=(50, 4000), attachment_size=(100, 20000),
+        users=50, seed=0, repo=None):
+    """Write a synthetic export zipfile to path.
+
+    The number of comments, logs and attachments of each issue, and the
+    size of the issue and comment bodies, are picked uniformly from the
+    given ``(min, max)`` ranges.   ``gap_rate`` is the fraction of issue
+    numbers that are missing.   The export is written incrementally, so
+    large exports can be generated in little memory.
+
+    The issue links in the text are to ``repo``, which defaults to path,
+    since run() migrates the export with its path as the repository.
+
+    """
+    if repo is None:
+        repo = path
+    rand = random.Random(seed)
+    usernames = ["user{}".format(i) for i in range(users)]
+    issue_ids = []
+    number = 0
+    while len(issue_ids) < issues:
+        number += 1
+        if rand.random() >= gap_rate:
+            issue_ids.append(number)
+
+    def user():
+        return rand.choice(usernames) if rand.random() > 0.05 else None
+
+    def write_section(out, name, records, first=False):
+        out.write('{}"{}": ['.format("" if first else ", ", name).encode())
+        for i, rec in enumerate(records):
+            if i:
+                out.write(b", ")
+            out.write(json.dumps(rec).encode("utf-8"))
+        out.write(b"]")
+
+    def issue_recs():
+        for issue_id in issue_ids:
+            created = _date(rand)
+            yield {
+                "id": issue_id,
+                "title": " ".join(
+                    rand.choice(_WORDS) for _ in range(rand.randint(3, 10))),
+                "content": _text(
+                    rand, rand.randint(*body_size), usernames, repo),
+                "reporter": user(),
+                "assignee": user(),
+                "status": rand.choice(_STATUSES),
+                "kind": rand.choice(["bug", "enhancement", "proposal"]),
+                "priority": rand.choice(["trivial", "minor", "major"]),
+                "component": rand.choice([None, "orm", "engine", "sql"]),
+                "milestone": rand.choice([None, "1.0", "1.1", "2.0"]),
+                "version": rand.choice([None, "0.9", "1.0"]),
+                "created_on": created,
+                "updated_on": created,
+                "edited_on": None,
+                "content_updated_on": None,
+                "watchers": [],
+                "voters": [],
+            }
+
+    def comment_recs():
+        comment_id = 0
+        for issue_id in issue_ids:
+            for _ in range(rand.randint(*comments)):
+                comment_id += 1
+                yield {
+                    "id": comment_id,
+                    "issue": issue_id,
+                    "user": user(),
+                    "content": _text(
+                        rand, rand.randint(*body_size) // 2, usernames,
+                        repo),
+                    "created_on": _date(rand),
+                    "updated_on": None,
+                }
+
+    def log_recs():
+        for issue_id in issue_ids:
+            for _ in range(rand.randint(*logs)):
+                yield {
+                    "issue": issue_id,
+                    "user": user(),
+                    "field": "status",
+                    "changed_from": rand.choice(_STATUSES),
+                    "changed_to": rand.choice(_STATUSES),
+                    "comment": None,
+                    "created_on": _date(rand),
+                }
+
+    attachment_recs = [
+        {
+            "issue": issue_id,
+            "filename": "file{}.txt".format(i),
+            "path": "attachments/{}-{}".format(issue_id, i),
+            "user": user(),
+        }
+        for issue_id in issue_ids
+        for i in range(rand.randint(*attachments))
+    ]
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_:
+        with zip_.open("db-1.0.json", "w") as out:
+            out.write(b"{")
+            write_section(out, "issues", issue_recs(), first=True)
+            write_section(out, "comments", comment_recs())
+            write_section(out, "logs", log_recs())
+            write_section(out, "attachments", attachment_recs)
+            for name in ("components", "milestones", "versions"):
+                write_section(out, name, [])
+            out.write(b', "meta": {}}')
+        for rec in attachment_recs:
+            zip_.writestr(
+                rec["path"],
+                os.urandom(rand.randint(*attachment_size)))
+
+
+class _StageTimer:
+    """Accumulates the calls to functions and the time spent in them,
+    by stage name."""
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, fn):
+        @functools.wraps(fn)
+        def timed(*arg, **kw):
+            start = time.perf_counter()
+            try:
+                return fn(*arg, **kw)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.times[stage] = self.times.get(stage, 0) + elapsed
+                    self.calls[stage] = self.calls.get(stage, 0) + 1
+        return timed
+
+    @contextlib.contextmanager
+    def patched(self, stages):
+        """Time the functions of ``{stage: [(owner, name), ...]}``."""
+        originals = []
+        for stage, targets in stages.items():
+            for owner, name in targets:
+                fn = getattr(owner, name)
+                originals.append((owner, name, fn))
+                setattr(owner, name, self.wrap(stage, fn))
+        try:
+            yield
+        finally:
+            for owner, name, fn in reversed(originals):
+                setattr(owner, name, fn)
+
+
+def run(export, args=(), config="config.yml", standin=None):
+    """Migrate export and return a dictionary of results.
+
+    The migration is a dry run, unless a StandIn is given to push the
+    issues to.
+
+    """
+
+    timer = _StageTimer()
+    stages = {
+        "load": [(BitbucketExport, "__init__")],
+        "fetch": [(main, "_fetch_issue_resources")],
+        "convert": [
+            (convert, "convert_issue"),
+            (convert, "convert_comment"),
+            (convert, "convert_change"),
+        ],
+        "push": [
+            (GitHub, "push_github_issue"),
+            (aio.AsyncGitHub, "push_github_issue"),
+        ],
+    }
+    if standin is None:
+        argv = [export, "bench/bench", "bench", "--dry-run"]
+    else:
+        server = standin.serve()
+        argv = [
+            export, standin.repo, "bench",
+            "--github-api-url", standin.url,
+        ]
+    argv += ["--offline", "--use-config", config] + list(args)
+
+    with timer.patched(stages), open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        original_getpass = getpass.getpass
+        if standin is not None:
+            # the stand-in accepts any password
+            getpass.getpass = lambda prompt: "bench"
+        try:
+            start = time.perf_counter()
+            main.main(argv)
+            elapsed = time.perf_counter() - start
+        finally:
+            getpass.getpass = original_getpass
+            if standin is not None:
+                server.shutdown()
+
+    issues = timer.calls.get("push", 0)
+    return {
+        "issues": issues,
+        "seconds": elapsed,
+        "issues_per_second": issues / elapsed if elapsed else 0,
+        "stages": timer.times,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _range(text):
+    low, _, high = text.partition(",")
+    return int(low), int(high or low)
+
+
+def _read_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the migration of a synthetic export."
+    )
+    parser.add_argument(
+        "--export",
+        help=(
+            "Export zipfile to migrate.  Unless --keep is given, a "
+            "synthetic export is generated here first, or in a temporary "
+            "directory if this isn't given."
+        )
+    )
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="Migrate the --export zipfile as is, without generating it."
+    )
+    parser.add_argument("--issues", type=int, default=1000)
+    parser.add_argument(
+        "--comments", type=_range, default=(0, 8), metavar="MIN,MAX")
+    parser.add_argument(
+        "--logs", type=_range, default=(0, 4), metavar="MIN,MAX")
+    parser.add_argument(
+        "--attachments", type=_range, default=(0, 2), metavar="MIN,MAX")
+    parser.add_argument(
+        "--body-size", type=_range, default=(50, 4000), metavar="MIN,MAX")
+    parser.add_argument("--gap-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--use-config", type=str, default="config.yml",
+        help="config.yml file to use.  defaults to config.yml."
+    )
+    parser.add_argument(
+        "--standin", action="store_true",
+        help=(
+            "Push the issues to a local stand-in for the GitHub API rather "
+            "than doing a dry run, to benchmark the push path."
+        )
+    )
+    parser.add_argument(
+        "--standin-pending", type=float, default=0.05, metavar="SECONDS",
+        help="Seconds an import stays pending on the stand-in."
+    )
+    parser.add_argument(
+        "--standin-latency", type=float, default=0, metavar="SECONDS",
+        help="Seconds taken by the stand-in to answer every request."
+    )
+    parser.add_argument(
+        "--standin-rate-limit", type=int, default=1000000, metavar="CALLS",
+        help=(
+            "Calls per hour allowed by the stand-in.  GitHub allows 5000, "
+            "which the migration spreads out over the hour; the default "
+            "is high enough not to slow the benchmark down."
+        )
+    )
+    parser.add_argument(
+        "--json", action="store_true",
+        help="Print the results as JSON, to be kept for comparison."
+    )
+    parser.add_argument(
+        "args", nargs="*",
+        help="Options passed on to the migration, after --"
+    )
+    return parser.parse_args(argv)
+
+
+def bench(argv=None):
+    """Entry point for the benchmark."""
+
+    options = _read_arguments(argv)
+    with tempfile.TemporaryDirectory(prefix="bbmigrate-bench") as tmp:
+        export = options.export or os.path.join(tmp, "export.zip")
+        if not options.keep:
+            start = time.perf_counter()
+            write_export(
+                export, issues=options.issues, comments=options.comments,
+                logs=options.logs, attachments=options.attachments,
+                gap_rate=options.gap_rate, body_size=options.body_size,
+                seed=options.seed)
+            print("generated {} issues in {:.1f} seconds".format(
+                options.issues, time.perf_counter() - start))
+        if options.standin:
+            standin = StandIn(
+                pending=options.standin_pending,
+                latency=options.standin_latency,
+                rate_limit=options.standin_rate_limit)
+        else:
+            standin = None
+        results = run(export, options.args, options.use_config, standin)
+
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    print("{issues} issues in {seconds:.2f} seconds, "
+          "{issues_per_second:.1f} issues/sec".format(**results))
+    for stage, seconds in sorted(results["stages"].items()):
+        print("  {:<10}{:8.2f} s".format(stage, seconds))
+    print("peak RSS {:.1f} MB".format(results["peak_rss_kb"] / 1024))
+
+
+if __name__ == "__main__":
+    bench()
@@ -14,26 +14,33 @@
 # along with the Bitbucket issue migration script.
 # If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import collections
+import contextlib
 import getpass
+import io
 import itertools
 import json
 import os
-import requests
 import warnings
 import time
 import zipfile
 
+from . import base
+from . import exportdb
 from .base import Client
 from .base import keyring
 
+USER_URL = "https://api.bitbucket.org/2.0/users/{}"
+
 
 class Bitbucket(Client):
     def __init__(self, config, options):
         self.config = config
         self.options = options
+        self.session = base.make_session(options)
         self._login()
-        self.auth = options.bb_auth
+        self.auth = self.session.auth = options.bb_auth
 
     def _login(self):
         options = self.options
@@ -44,7 +51,7 @@ class Bitbucket(Client):
         options.bb_auth = None
         options.users = dict(user.split('=') for user in options._map_users)
 
-        bb_repo_status = requests.head(bb_url).status_code
+        bb_repo_status = self.session.head(bb_url).status_code
         if bb_repo_status == 404:
             raise RuntimeError(
                 "Could not find a Bitbucket Issue Tracker at: {}\n"
@@ -73,7 +80,7 @@ class Bitbucket(Client):
             )
             options.bb_auth = (options.bitbucket_username, bitbucket_password)
             # Verify BB creds work
-            bb_creds_status = requests.head(
+            bb_creds_status = self.session.head(
                 bb_url, auth=options.bb_auth).status_code
             if bb_creds_status == 401:
                 raise RuntimeError("Failed to login to Bitbucket.")
@@ -95,7 +102,7 @@ class Bitbucket(Client):
 
         while next_url is not None:
             respo = self._expect_200(
-                requests.get(next_url, auth=self.auth, params=params),
+                self.session.get(next_url, params=params),
                 next_url
             )
             result = respo.json()
@@ -128,7 +135,7 @@ class Bitbucket(Client):
 
         while next_url is not None:
             respo = self._expect_200(
-                requests.get(next_url, auth=self.auth, params={"sort": "id"}),
+                self.session.get(next_url, params={"sort": "id"}),
                 next_url
             )
             rec = respo.json()
@@ -148,7 +155,7 @@ class Bitbucket(Client):
 
         while next_url is not None:
             respo = self._expect_200(
-                requests.get(next_url, auth=self.auth, params={"sort": "id"}),
+                self.session.get(next_url, params={"sort": "id"}),
                 next_url, warn=(500,)
             )
             # unfortunately, BB's v 2.0 API seems to be 500'ing on some of
@@ -169,21 +176,36 @@ class Bitbucket(Client):
     def get_attachments(self, issue_num):
         url = "{}/{}/attachments".format(self.url, issue_num)
         respo = self._expect_200(
-            requests.get(url, auth=self.auth), url
+            self.session.get(url), url
         )
         result = respo.json()
         return result['values']
 
     def get_attachment(self, issue_num, filename):
+        with self.open_attachment(issue_num, filename) as file_:
+            return file_.read()
+
+    @contextlib.contextmanager
+    def open_attachment(self, issue_num, filename):
+        """Return the content of an attachment as a binary file object.
+
+        The content is streamed from the response rather than read into
+        memory.
+
+        """
         # this seems to be in val['links']['self']['href'][0] also
         content_url = "{}/{}/attachments/{}".format(
             self.url, issue_num, filename)
         for retry in range(5):
-            content = self._expect_200(
-                requests.get(content_url, auth=self.auth),
-                content_url, warn=(403,)
-            )
+            content = self.session.get(content_url, stream=True)
+            try:
+                self._expect_200(content, content_url, warn=(403,))
+            except Exception:
+                # give the streamed connection back to the pool
+                content.close()
+                raise
             if content.status_code == 403:
+                content.close()
                 warnings.warn(
                     "Got a 403 from %s, waiting a few seconds then "
                     "trying again" % content_url)
@@ -192,36 +214,149 @@ class Bitbucket(Client):
             else:
                 break
         else:
-            return "Couldn't download attachment: %s" % content_url
+            yield io.BytesIO(
+                b"Couldn't download attachment: " +
+                content_url.encode("utf-8"))
+            return
 
-        return content.content
+        with content:
+            content.raw.decode_content = True
+            yield content.raw
 
 
 class BitbucketExport(Client):
     def __init__(self, config, options):
         self.config = config
         self.options = options
+        self.session = base.make_session(options)
         self.zipfile = zipfile.ZipFile(options.bitbucket_repo)
+        self.exportdb = None
         with self.zipfile.open("db-1.0.json", "r") as file_:
-            self.db = json.load(file_)
+            if options.stream_export:
+                self._load_stream(file_)
+            else:
+                self.db = json.load(file_)
+                self._build_index()
         self._user_map = {}
         options.users = dict(user.split('=') for user in options._map_users)
 
+    def _build_index(self):
+        """Group comments, logs and attachments by issue id.
+
+        This is done once up front so that the per-issue lookups don't
+        need to scan the full export for every issue.
+
+        """
+        self._issues = sorted(self.db['issues'], key=lambda rec: rec["id"])
+        self._issue_ids = [rec["id"] for rec in self._issues]
+
+        self._comments = _index_by_issue(
+            filter(_comment_filter, self.db['comments']),
+            key=_created_on
+        )
+        self._logs = _index_by_issue(
+            filter(_log_filter, self.db['logs']),
+            key=_created_on
+        )
+        self._attachments = {
+            issue_id: self._prepare_attachments(recs)
+            for issue_id, recs in
+            _index_by_issue(self.db['attachments']).items()
+        }
+
+    def _load_stream(self, file_):
+        """Stream the export into an on-disk index.
+
+        Used for exports that are too large to be loaded into memory;
+        the records are only read back as each issue is migrated.
+
+        """
+        print("streaming {} into a temporary index".format(
+            self.options.bitbucket_repo))
+        self.exportdb = exportdb.ExportDB.load(
+            file_,
+            {
+                "issues": (None, None),
+                "comments": (_comment_filter, _created_on),
+                "logs": (_log_filter, _created_on),
+                "attachments": (None, None),
+            }
+        )
+        self._comments = self.exportdb.section("comments")
+        self._logs = self.exportdb.section("logs")
+        self._attachments = self.exportdb.section("attachments")
+
+    def _prepare_attachments(self, recs):
+        # dupe renaming goes by the order in the export, then
+        # the paths are sorted just for deterministic ordering, as
+        # the paths are hashes
+        return sorted(
+            self._rename_for_dupes(recs), key=lambda rec: rec["path"])
+
+    def _get_attachment_recs(self, issue_id):
+        recs = self._attachments.get(issue_id, ())
+        if self.exportdb is not None:
+            # records come back from the database in export order
+            recs = self._prepare_attachments(recs)
+        return recs
+
     def _get_user_display_name(self, name):
         if name is None:
             return "anonymous"
         if name not in self._user_map:
-            url = "https://api.bitbucket.org/2.0/users/{}".format(name)
-            resp = self._expect_200(requests.get(url), url, warn=(404, ))
-            if resp.status_code == 404:
-                self._user_map[name] = {"username": name, "display_name": name}
-            else:
-                self._user_map[name] = resp.json()
+            try:
+                self._user_map[name] = self._cached_user(name)
+            except KeyError:
+                self._user_map[name] = self._fetch_user(name)
         return self._user_map[name]['display_name']
 
+    def _cached_user(self, name):
+        cache = self.options.user_cache
+        if cache is None:
+            raise KeyError(name)
+        return cache.lookup("bitbucket", name)
+
+    def _fetch_user(self, name):
+        if self.options.offline:
+            return {"username": name, "display_name": name}
+        url = USER_URL.format(name)
+        return self._user_fetched(name, url, self.session.get(url))
+
+    def _user_fetched(self, name, url, resp):
+        resp = self._expect_200(resp, url, warn=(404, ))
+        if resp.status_code == 404:
+            user = {"username": name, "display_name": name}
+        else:
+            user = resp.json()
+        if self.options.user_cache is not None:
+            self.options.user_cache.set(
+                "bitbucket", name, user, negative=resp.status_code == 404)
+        return user
+
+    def get_usernames(self):
+        """Return the set of all users referenced by the export."""
+
+        if self.exportdb is not None:
+            issues = self.exportdb.records("issues")
+            comments = self.exportdb.records("comments")
+            logs = self.exportdb.records("logs")
+        else:
+            issues = self._issues
+            comments = itertools.chain.from_iterable(self._comments.values())
+            logs = itertools.chain.from_iterable(self._logs.values())
+
+        names = {rec["reporter"] for rec in issues}
+        names.update(rec["user"] for rec in comments)
+        names.update(rec["user"] for rec in logs)
+        names.discard(None)
+        return names
+
     def get_issues(self, offset):
-        recs = [rec for rec in self.db['issues'] if rec["id"] > offset]
-        recs = sorted(recs, key=lambda rec: rec["id"])
+        if self.exportdb is not None:
+            recs = self.exportdb.issues(offset)
+        else:
+            start = bisect.bisect_right(self._issue_ids, offset)
+            recs = self._issues[start:]
         for rec in recs:
             yield self._export_issue_to_api20(rec)
 
@@ -245,12 +380,10 @@ class BitbucketExport(Client):
         }
 
     def get_issue_comments(self, issue_id):
-        recs = [
-            rec for rec in self.db['comments'] if rec["issue"] == issue_id
-            and rec["content"]
+        return [
+            self._export_comment_to_api20(rec)
+            for rec in self._comments.get(issue_id, ())
         ]
-        recs = sorted(recs, key=lambda rec: rec["created_on"])
-        return [self._export_comment_to_api20(rec) for rec in recs]
 
     def _export_comment_to_api20(self, comment):
         return {
@@ -264,11 +397,7 @@ class BitbucketExport(Client):
         }
 
     def get_issue_changes(self, issue_id):
-        recs = [
-            rec for rec in self.db['logs'] if rec["issue"] == issue_id
-            and (rec["changed_to"] or rec["changed_from"])
-        ]
-        recs = sorted(recs, key=lambda rec: rec["created_on"])
+        recs = self._logs.get(issue_id, ())
 
         return [
             self._export_change_to_api20(list(sub_recs))
@@ -308,28 +437,65 @@ class BitbucketExport(Client):
         return attachment_recs
 
     def get_attachments(self, issue_id):
-        recs = self._rename_for_dupes([
-            rec for rec in self.db['attachments'] if rec["issue"] ==
-            issue_id])
-
-        # this is just for deterministic sorting, the paths
-        # are hashes
-        recs = sorted(recs, key=lambda rec: rec["path"])
-        return [{"name": rec["filename"]} for rec in recs]
+        return [
+            {"name": rec["filename"]}
+            for rec in self._get_attachment_recs(issue_id)
+        ]
 
     def get_attachment(self, issue_id, filename):
-        recs = self._rename_for_dupes([
-            rec for rec in self.db['attachments'] if rec["issue"] ==
-            issue_id])
+        with self.open_attachment(issue_id, filename) as file_:
+            return file_.read()
+
+    def open_attachment(self, issue_id, filename):
+        """Return the content of an attachment as a binary file object."""
+
+        recs = self._get_attachment_recs(issue_id)
 
         for rec in recs:
             if rec["filename"] == filename:
-                with self.zipfile.open(rec["path"], 'r') as file_:
-                    return file_.read()
-                break
+                return self.zipfile.open(rec["path"], 'r')
         else:
             raise RuntimeError(
                 "Can't find a unique attachment for {} {}, got {}".format(
                     issue_id, filename, repr(recs)
                 )
             )
+
+
+def _comment_filter(rec):
+    return rec["content"]
+
+
+def _log_filter(rec):
+    return rec["changed_to"] or rec["changed_from"]
+
+
+def _created_on(rec):
+    return rec["created_on"]
+
+
+def _index_by_issue(recs, key=None):
+    """Return a dictionary of issue id to the list of records for that issue.
+
+    If key is given, each list is sorted by it; the sort is stable so
+    records with the same key stay in export order.
+
+    >>> index = _index_by_issue(
+    ...     [
+    ...         dict(issue=1, created_on="b"),
+    ...         dict(issue=2, created_on="a"),
+    ...         dict(issue=1, created_on="a"),
+    ...     ],
+    ...     key=lambda rec: rec["created_on"]
+    ... )
+    >>> sorted(index)
+    [1, 2]
+    >>> [rec["created_on"] for rec in index[1]]
+    ['a', 'b']
+    """
+    if key is not None:
+        recs = sorted(recs, key=key)
+    index = collections.defaultdict(list)
+    for rec in recs:
+        index[rec["issue"]].append(rec)
+    return dict(index)
@@ -14,26 +14,95 @@
 # along with the Bitbucket issue migration script.
 # If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import concurrent.futures
+import functools
 import re
-import requests
+import string
 
 from . import base
 
 SEP = "-" * 40
 
 
+class Config(dict):
+    """The contents of the config file, with its templates compiled."""
+
+    def __init__(self, *arg, **kw):
+        super().__init__(*arg, **kw)
+        self.templates = Templates(self)
+
+
+def _template(text):
+    """Return the bound ``str.format`` of a template, after checking that
+    it parses, so that a malformed template fails when the config is
+    loaded rather than halfway through the migration.
+
+    >>> _template("{user!r} said {text:>6}")(user="me", text="hi")
+    "'me' said     hi"
+    >>> _template("{user")
+    Traceback (most recent call last):
+    ...
+    ValueError: expected '}' before end of string
+    """
+    for _ in string.Formatter().parse(text):
+        pass
+    return text.format
+
+
+class Templates:
+    """The templates of a config, ready to be called with their fields.
+
+    Also holds the rendered user block of each user, see format_user().
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.issue = _template(config['issue_template'])
+        self.issue_skip_user = _template(config['issue_template_skip_user'])
+        self.comment = _template(config['comment_template'])
+        self.comment_skip_user = _template(
+            config['comment_template_skip_user'])
+        self.change = _template(config['change_template'])
+        self.linked_attachments = _template(
+            config['linked_attachments_template'])
+        self.names_only_attachments = _template(
+            config['names_only_attachments_template'])
+        self.bitbucket_user_badge = _template(
+            config['bitbucket_user_badge_template'])
+        self.github_user_badge = _template(
+            config['github_user_badge_template'])
+        self.user = _template(config['user_template'].strip())
+        self.users = {}
+
+
+def _templates(options, config):
+    try:
+        return config.templates
+    except AttributeError:
+        # a plain dictionary, not loaded through Config; its templates
+        # are compiled on first use and kept with the options, rather
+        # than written into the caller's dictionary
+        templates = getattr(options, "templates", None)
+        if templates is None or templates.config is not config:
+            templates = options.templates = Templates(config)
+        return templates
+
+
 def process_wiki_attachments(
-        issue_num, bitbucket, options, attachments_repo):
+        issue_num, bitbucket, options, attachments_repo,
+        bb_attachments=None):
     attachment_links = []
 
-    bb_attachments = bitbucket.get_attachments(issue_num)
+    if bb_attachments is None:
+        bb_attachments = bitbucket.get_attachments(issue_num)
 
     for val in bb_attachments:
         filename = val['name']
-        content = bitbucket.get_attachment(issue_num, filename)
-
-        link = attachments_repo.add_attachment(
-            issue_num, filename, content)
+        with bitbucket.open_attachment(issue_num, filename) as content:
+            link = attachments_repo.add_attachment(
+                issue_num, filename, content)
         attachment_links.append(
             {
                 "name": filename,
@@ -43,22 +112,51 @@ def process_wiki_attachments(
     if bb_attachments:
         if not options.dry_run:
             attachments_repo.commit(issue_num)
+            # pushes only if a batch is due; see AttachmentsRepo
             attachments_repo.push()
 
     return attachment_links
 
 
-def get_attachment_names(issue_num, bitbucket):
+def prefetch_users(bitbucket, options, workers):
+    """Resolve every user in the export ahead of the conversion.
+
+    The Bitbucket display names and GitHub usernames are looked up using
+    a pool of threads, so that converting issues doesn't have to wait on
+    them one at a time.
+
+    """
+    usernames = sorted(bitbucket.get_usernames())
+    print("prefetching {} users".format(len(usernames)))
+
+    def resolve(username):
+        bitbucket._get_user_display_name(username)
+        if username.lower() != "guest":
+            _gh_username(
+                username, options.users, options.gh, options.user_cache,
+                options.offline)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for _ in executor.map(resolve, usernames):
+            pass
+
+
+def get_attachment_names(issue_num, bitbucket, bb_attachments=None):
     """Get the names of attachments on this issue."""
 
-    bb_attachments = bitbucket.get_attachments()
+    if bb_attachments is None:
+        bb_attachments = bitbucket.get_attachments(issue_num)
     return [{"name": val['name'], "link": None} for val in bb_attachments]
 
 
 def convert_issue(
-        issue, comments, changes, options, attachment_links, gh, config):
+        issue, comments, changes, options, attachment_links, gh, config,
+        content=None):
     """
     Convert an issue schema from Bitbucket to GitHub's Issue Import API
+
+    content is the already converted issue content, if any; see
+    convert_content().
     """
     # Bitbucket issues have an 'is_spam' field that Akismet sets true/false.
     # they still need to be imported so that issue IDs stay sync'd
@@ -89,7 +187,7 @@ def convert_issue(
     out = {
         'title': issue['title'],
         'body': format_issue_body(
-            issue, attachment_links, options, config),
+            issue, attachment_links, options, config, content),
         'closed': is_closed,
         'created_at': convert_date(issue['created_on']),
         'updated_at': convert_date(issue['updated_on']),
@@ -124,14 +222,14 @@ def convert_issue(
     return out
 
 
-def convert_comment(comment, options, config):
+def convert_comment(comment, options, config, content=None):
     """
     Convert an issue comment from Bitbucket schema to GitHub's Issue Import API
     schema.
     """
     return {
         'created_at': convert_date(comment['created_on']),
-        'body': format_comment_body(comment, options, config),
+        'body': format_comment_body(comment, options, config, content),
     }
 
 
@@ -149,25 +247,23 @@ def convert_change(change, options, config, gh):
     }
 
 
-def format_issue_body(issue, attachment_links, options, config):
-    content = issue['content']['raw']
-    content = convert_changesets(content, options)
-    content = convert_creole_braces(content)
-    content = convert_code_block_langs(content)
-    content = convert_links(content, options)
-    content = convert_users(content, options)
+def format_issue_body(
+        issue, attachment_links, options, config, content=None):
+    if content is None:
+        content = convert_content(issue['content']['raw'], options)
 
     reporter = issue.get('reporter')
+    templates = _templates(options, config)
 
     if options.attachments_wiki and attachment_links:
-        attachments = config['linked_attachments_template'].format(
+        attachments = templates.linked_attachments(
             attachment_links=" | ".join(
                 "[{}]({})".format(link['name'], link['link'])
                 for link in attachment_links),
             sep=SEP
         )
     elif options.mention_attachments and attachment_links:
-        attachments = config['names_only_attachments_template'].format(
+        attachments = templates.names_only_attachments(
             attachment_names=", ".join(
                 "{}".format(link['name'])
                 for link in attachment_links),
@@ -186,18 +282,14 @@ def format_issue_body(issue, attachment_links, options, config):
         attachments=attachments
     )
     skip_user = reporter and reporter['username'] == options.bb_skip
-    template = config['issue_template_skip_user'] \
-        if skip_user else config['issue_template']
-    return template.format(**data)
+    template = templates.issue_skip_user \
+        if skip_user else templates.issue
+    return template(**data)
 
 
-def format_comment_body(comment, options, config):
-    content = comment['content']['raw']
-    content = convert_changesets(content, options)
-    content = convert_creole_braces(content)
-    content = convert_code_block_langs(content)
-    content = convert_links(content, options)
-    content = convert_users(content, options)
+def format_comment_body(comment, options, config, content=None):
+    if content is None:
+        content = convert_content(comment['content']['raw'], options)
 
     author = comment['user']
     data = dict(
@@ -206,9 +298,163 @@ def format_comment_body(comment, options, config):
         content=content,
     )
     skip_user = author and author['username'] == options.bb_skip
-    template = config['comment_template_skip_user'] if skip_user \
-        else config['comment_template']
-    return template.format(**data)
+    templates = _templates(options, config)
+    template = templates.comment_skip_user if skip_user \
+        else templates.comment
+    return template(**data)
+
+
+def convert_content(content, options):
+    """Convert the markup of an issue or comment to GitHub's flavor.
+
+    This gives the same result as running convert_changesets(),
+    convert_creole_braces(), convert_code_block_langs(), convert_links()
+    and convert_users() in that order; see MarkupConverter.
+
+    """
+    return _markup_converter(options.bitbucket_repo).convert(
+        content, options.users)
+
+
+@functools.lru_cache()
+def _markup_converter(bitbucket_repo):
+    return MarkupConverter(bitbucket_repo)
+
+
+class MarkupConverter:
+    """Converts Bitbucket markup with precompiled patterns.
+
+    The creole braces and the code block language markers are rewritten
+    in a single pass over the lines, chaining generators.  Changesets,
+    issue links and @mentions are each a single regular expression
+    substitution over the whole text, done in the same order as the
+    individual convert_*() functions so that the output is identical to
+    theirs.
+
+    >>> converter = MarkupConverter("someone/repo")
+    >>> print(converter.convert(
+    ...     "see https://bitbucket.org/someone/repo/issue/12 by @fk\\n"
+    ...     "```\\n#!python\\nprint('hi')\\n```",
+    ...     {"fk": "fkrull"}
+    ... ))
+    see #12 by @fkrull
+    ```
+    print('hi')
+    ```
+    """
+
+    def __init__(self, bitbucket_repo):
+        self.links_re = re.compile(
+            r'https://bitbucket.org/{repo}/issue/(\d+)'.format(
+                repo=bitbucket_repo))
+
+    def convert(self, content, users):
+        content = CHANGESET_RE.sub(r"\1", content)
+        content = "\n".join(self._convert_lines(content.splitlines()))
+        content = self.links_re.sub(r'#\1', content)
+
+        def replace_user(match):
+            matched = match.group()[1:]
+            return '@' + (users.get(matched) or matched)
+
+        return MENTION_RE.sub(replace_user, content)
+
+    def _convert_lines(self, lines):
+        # the individual functions join the lines of convert_creole_braces()
+        # and split them again in convert_code_block_langs(), which loses
+        # a trailing empty line
+        return self._code_block_lines(
+            _without_trailing_empty(self._creole_lines(lines)))
+
+    def _creole_lines(self, lines):
+        """The line rewrites of convert_creole_braces()."""
+
+        in_block = False
+        for line in lines:
+            if line.startswith("{{{") or line.startswith("}}}"):
+                if "{{{" in line:
+                    yield '    ' + line.partition("{{{")[2]
+                    in_block = True
+                if "}}}" in line:
+                    yield '    ' + line.partition("}}}")[0]
+                    in_block = False
+            elif in_block:
+                yield "    " + line
+            else:
+                yield line.replace("{{{", "`").replace("}}}", "`")
+
+    def _code_block_lines(self, lines):
+        """The line rewrites of convert_code_block_langs()."""
+
+        in_block = False
+        in_whitespace_block = False
+        first_line = False
+        for line in lines:
+            if line.startswith('    '):
+                if not in_whitespace_block:
+                    in_whitespace_block = first_line = True
+            elif in_whitespace_block and line:
+                in_whitespace_block = first_line = False
+
+            if line.startswith("```"):
+                if in_block:
+                    in_block = first_line = False
+                else:
+                    in_block = first_line = True
+                yield line
+            elif in_block and first_line and CODE_LANG_RE.match(line):
+                pass
+            elif in_whitespace_block and first_line and \
+                    INDENTED_CODE_LANG_RE.match(line):
+                pass
+            else:
+                if not line and first_line:
+                    continue
+                yield line
+                first_line = False
+
+
+def _without_trailing_empty(lines):
+    pending = None
+    for line in lines:
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending:
+        yield pending
+
+
+def contents_options(options):
+    """Return the subset of options that convert_content() uses.
+
+    This is passed to the processes that run convert_contents().  The users
+    that were looked up on GitHub only ever map to themselves, so a snapshot
+    of options.users converts @mentions the same way as the full mapping.
+
+    """
+    return argparse.Namespace(
+        bitbucket_repo=options.bitbucket_repo,
+        users=dict(options.users)
+    )
+
+
+_contents_options = None
+
+
+def init_contents_worker(options):
+    global _contents_options
+    _contents_options = options
+
+
+def convert_contents(contents):
+    """Run convert_content() in a worker process set up by
+    init_contents_worker(); None values are passed through."""
+
+    return [
+        convert_content(content, _contents_options)
+        if content is not None else None
+        for content in contents
+    ]
 
 
 def format_change_body(change, options, config, gh):
@@ -325,25 +571,49 @@ def format_change_body(change, options, config, gh):
         sep=SEP,
         changes="\n".join(changes)
     )
-    template = config['change_template']
-    return template.format(**data)
+    return _templates(options, config).change(**data)
 
 
-def _gh_username(username, users, gh_auth):
+def _gh_username(username, users, gh, cache=None, offline=False):
     try:
-        return users[username]
+        return _known_gh_username(username, users, cache, offline)
     except KeyError:
         pass
 
     # Verify GH user link doesn't 404. Unfortunately can't use
     # https://github.com/<name> because it might be an organization
-    gh_user_url = 'https://api.github.com/users/' + username
-    status_code = requests.head(gh_user_url, auth=gh_auth).status_code
+    gh_user_url, status_code = gh.user_status(username)
+    return _checked_gh_username(
+        username, users, cache, gh_user_url, status_code)
+
+
+def _known_gh_username(username, users, cache, offline):
+    """Return the GitHub username if it's known without asking GitHub,
+    otherwise raise KeyError."""
+
+    try:
+        return users[username]
+    except KeyError:
+        if offline:
+            # only the users mapped with --map-user are known
+            return None
+
+    if cache is None:
+        raise KeyError(username)
+    users[username] = cache.lookup("github", username)
+    return users[username]
+
+
+def _checked_gh_username(username, users, cache, gh_user_url, status_code):
     if status_code == 200:
         users[username] = username
+        if cache is not None:
+            cache.set("github", username, username)
         return username
     elif status_code == 404:
         users[username] = None
+        if cache is not None:
+            cache.set("github", username, None, negative=True)
         return None
     elif status_code == 403:
         raise RuntimeError(
@@ -373,12 +643,22 @@ def format_user(user, options, config):
     # 'reported_by' key, so just be sure to pass in None
     if user is None or user['username'].lower() == "guest":
         return "Anonymous"
-    bb_user = config['bitbucket_user_badge_template'].format(
+
+    # the result only depends on the user, so it's rendered once per user
+    templates = _templates(options, config)
+    key = (user['username'], user['display_name'])
+    try:
+        return templates.users[key]
+    except KeyError:
+        pass
+
+    bb_user = templates.bitbucket_user_badge(
         **{"bb_user": user['username']})
     gh_username = _gh_username(
-        user['username'], options.users, options.gh_auth)
+        user['username'], options.users, options.gh,
+        options.user_cache, options.offline)
     if gh_username is not None:
-        gh_user = config['github_user_badge_template'].format(
+        gh_user = templates.github_user_badge(
             **{"gh_user": gh_username})
     else:
         gh_user = ""
@@ -390,7 +670,8 @@ def format_user(user, options, config):
         "gh_user_badge": gh_user,
         "display_name": user['display_name']
     }
-    return config['user_template'].strip().format(**data)
+    templates.users[key] = formatted = templates.user(**data)
+    return formatted
 
 
 def convert_date(bb_date):
@@ -403,14 +684,15 @@ def convert_date(bb_date):
     raise RuntimeError("Could not parse date: {}".format(bb_date))
 
 
+CHANGESET_RE = re.compile(r"<<(?:cset|changeset) (.+?)>>")
+
+
 def convert_changesets(content, options):
     """
     fix up changeset symbols
     """
 
-    changeset_re = re.compile(r"<<(?:cset|changeset) (.+?)>>")
-
-    return changeset_re.sub(
+    return CHANGESET_RE.sub(
         lambda m: m.group(1), content
     )
 
@@ -442,6 +724,10 @@ def convert_creole_braces(content):
     return "\n".join(lines)
 
 
+CODE_LANG_RE = re.compile(r'^#!\w+$')
+INDENTED_CODE_LANG_RE = re.compile(r'^    #!\w+$')
+
+
 def convert_code_block_langs(content):
     """Remove the symbols like "#!python", "#!diff"
 
@@ -466,10 +752,10 @@ def convert_code_block_langs(content):
             else:
                 in_block = first_line = True
             lines.append(line)
-        elif in_block and first_line and re.match(r'^#!\w+$', line):
+        elif in_block and first_line and CODE_LANG_RE.match(line):
             pass
         elif in_whitespace_block and first_line and \
-                re.match(r'^    #!\w+$', line):
+                INDENTED_CODE_LANG_RE.match(line):
             pass
         else:
             if not line and first_line:
@@ -0,0 +1,141 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk index of the records in a Bitbucket export.
+
+The records are streamed out of ``db-1.0.json`` into a temporary SQLite
+database keyed on issue id, so that a large export can be migrated without
+holding it in memory.
+
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+from . import jsonstream
+
+
+class ExportDB:
+    def __init__(self):
+        self._tempdir = tempfile.TemporaryDirectory(prefix="bbmigrate")
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            os.path.join(self._tempdir.name, "export.db"),
+            check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute(
+            "CREATE TABLE records (section TEXT, issue INTEGER, "
+            "sort_key TEXT, seq INTEGER, data TEXT)"
+        )
+
+    @classmethod
+    def load(cls, file_, sections, batch_size=1000):
+        """Stream the export in ``file_`` into a new ExportDB.
+
+        ``sections`` is a dictionary of section name, e.g. "comments", to
+        a ``(filter, sort_key)`` tuple of callables, either of which may be
+        None.  Sections that aren't named are skipped.
+
+        """
+        db = cls()
+        batch = []
+        for seq, (section, rec) in enumerate(jsonstream.iter_arrays(file_)):
+            if section not in sections:
+                continue
+            filter_, sort_key = sections[section]
+            if filter_ is not None and not filter_(rec):
+                continue
+            batch.append((
+                section,
+                rec["id"] if section == "issues" else rec["issue"],
+                sort_key(rec) if sort_key is not None else "",
+                seq,
+                json.dumps(rec)
+            ))
+            if len(batch) >= batch_size:
+                db._insert(batch)
+                batch[:] = []
+        db._insert(batch)
+        db.conn.execute(
+            "CREATE INDEX records_idx ON records "
+            "(section, issue, sort_key, seq)"
+        )
+        db.conn.commit()
+        return db
+
+    def _insert(self, batch):
+        self.conn.executemany(
+            "INSERT INTO records VALUES (?, ?, ?, ?, ?)", batch)
+
+    def _query(self, sql, params):
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def issues(self, offset, batch_size=500):
+        """Yield the issue records with an id above offset, in id order."""
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT issue, data FROM records "
+                    "WHERE section = 'issues' AND issue > ? "
+                    "ORDER BY issue LIMIT ?",
+                    (offset, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            # continue the next batch from the last id seen
+            for offset, data in rows:
+                yield json.loads(data)
+
+    def records(self, section, batch_size=1000):
+        """Yield all the records of a section."""
+        rowid = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT rowid, data FROM records "
+                    "WHERE section = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (section, rowid, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for rowid, data in rows:
+                yield json.loads(data)
+
+    def section(self, name):
+        return _Section(self, name)
+
+
+class _Section:
+    """Dictionary-like access to the records of a section by issue id."""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def get(self, issue_id, default=None):
+        recs = self.db._query(
+            "SELECT data FROM records WHERE section = ? AND issue = ? "
+            "ORDER BY sort_key, seq",
+            (self.name, issue_id)
+        )
+        return recs or default
@@ -14,8 +14,11 @@
 # along with the Bitbucket issue migration script.
 # If not, see <http://www.gnu.org/licenses/>.
 
-import contextlib
+import collections
+import concurrent.futures
 import getpass
+import hashlib
+import io
 import os
 import pprint
 import random
@@ -23,24 +26,48 @@ import requests
 import subprocess
 import tempfile
 import time
+import urllib.parse
 
+from . import journal
 from .base import Client
 from .base import keyring
+from .ratelimit import RateLimiter
+
+# size of the chunks attachments are copied in
+CHUNK_SIZE = 65536
 
 
 class GitHub(Client):
     # GitHub's Import API currently requires a special header
     headers = {'Accept': 'application/vnd.github.golden-comet-preview+json'}
-    _last_push_time = 0
-    _rate_limit = None
 
     def __init__(self, config, options):
         self.config = config
         self.options = options
-        self._login()
+        self.rate_limiter = RateLimiter(metrics=options.metrics)
         self.repo = options.github_repo
+        self.url = '{}/repos/{}'.format(
+            options.github_api_url, options.github_repo)
+        self.import_tracker = ImportTracker(self, options.import_window)
+        self.journal = options.journal
+        if options.offline and options.dry_run:
+            # a dry run against an empty repo, without contacting GitHub
+            options.gh_auth = None
+            self.milestones = {}
+            self.labels = set()
+            self.label_translations = self.config['label_translations']
+            return
+        self._login()
         self._load_milestones()
         self._load_labels()
+        if options.verify or options.compile_to:
+            # only reading the repository, or compiling a spool, which
+            # gets its offset when it is pushed
+            return
+        if self.journal is not None:
+            self._resume_from_journal()
+        if options.delta:
+            return
         if not options.skip:
             options.skip = self._get_current_offset()
             if options.skip:
@@ -48,11 +75,41 @@ class GitHub(Client):
                     "Detected highest issue number in the "
                     "github repo as {}, setting offset".format(options.skip))
 
+    def _resume_from_journal(self):
+        """Finish the imports in progress and take the offset from the
+        journal, rather than querying GitHub for it."""
+
+        pending = self.journal.pending()
+        if pending:
+            print(
+                "Resuming verification of imports in progress for "
+                "issues {}".format(
+                    ", ".join(str(issue_id) for issue_id, _ in pending)))
+            for verify_issue_id, status_url in pending:
+                self.import_tracker.add(verify_issue_id, status_url)
+            self.finish_imports()
+
+        if self.options.skip or self.options.delta:
+            # --delta picks issues by the journal rather than an offset
+            return
+        unposted = self.journal.unposted()
+        if unposted:
+            # we don't know if the POST went through, or the import
+            # failed and has to be POSTed again; ask GitHub
+            print(
+                "Journal doesn't have issues {} as imported, "
+                "detecting the offset from GitHub".format(
+                    ", ".join(str(issue_id) for issue_id in unposted)))
+        else:
+            self.options.skip = self.journal.offset()
+            if self.options.skip:
+                print(
+                    "Resuming after issue {} from the journal".format(
+                        self.options.skip))
+
     def _login(self):
         options = self.options
-        self.url = gh_repo_url = (
-            'https://api.github.com/repos/{}'.format(options.github_repo)
-        )
+        gh_repo_url = self.url
 
         # Always need the GH pass so format_user() can verify links to GitHub
         # user profiles don't 404. Auth'ing necessary to get higher GH rate
@@ -86,7 +143,9 @@ class GitHub(Client):
         self.session = requests.Session()
         self.session.auth = options.gh_auth
         self.session.headers.update(self.headers)
-        self.session.hooks["response"].append(self._update_rate_limit)
+        self.session.hooks["response"].append(self.rate_limiter.update)
+        self.session.hooks["response"].append(
+            options.metrics.http_hook("github"))
         response = self._expect_200(
             self._api_call(self.session.get, gh_repo_url), gh_repo_url
         )
@@ -111,9 +170,8 @@ class GitHub(Client):
 
     def _get_current_offset(self):
         url = (
-            "https://api.github.com/repos/{repo}/issues"
-            "?sort=number&direction=desc&state=all".format(
-                repo=self.repo)
+            "{url}/issues?sort=number&direction=desc&state=all".format(
+                url=self.url)
         )
         resp = self._expect_200(
             self._api_call(self.session.get, url), url
@@ -124,11 +182,50 @@ class GitHub(Client):
         else:
             return 0
 
+    def user_status(self, username):
+        """Return the API URL of a GitHub user and the HTTP status code
+        of a HEAD request to it."""
+        url = '{}/users/{}'.format(self.options.github_api_url, username)
+        return url, self._api_call(self.session.head, url).status_code
+
+    def get_all_issues(self, workers):
+        """Yield every issue and pull request of the repository.
+
+        The first page tells how many pages there are, and the rest are
+        fetched up to ``workers`` at a time.
+        """
+        issues, last_page = self._get_issues_page(1)
+        yield from issues
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for issues, _ in executor.map(
+                    self._get_issues_page, range(2, last_page + 1)):
+                yield from issues
+
+    def _get_issues_page(self, page):
+        url, params = self._issues_page_request(page)
+        respo = self._api_call(self.session.get, url, params=params)
+        return self._issues_page(url, respo)
+
+    def _issues_page_request(self, page):
+        return '{url}/issues'.format(url=self.url), {
+            'state': 'all', 'sort': 'created', 'direction': 'asc',
+            'per_page': 100, 'page': page,
+        }
+
+    def _issues_page(self, url, respo):
+        """Return the issues of a page and the number of the last page."""
+        self._expect_200(respo, url)
+        if 'last' in respo.links:
+            query = urllib.parse.urlsplit(respo.links['last']['url']).query
+            last_page = int(urllib.parse.parse_qs(query)['page'][0])
+        else:
+            last_page = 1
+        return respo.json(), last_page
+
     def _load_milestones(self):
         self.milestones = {}
         self._milestone_url = url = \
-            'https://api.github.com/repos/{repo}/milestones?state=all'.\
-            format(repo=self.repo)
+            '{url}/milestones?state=all'.format(url=self.url)
         while url:
             respo = self._expect_200(
                 self._api_call(self.session.get, url), url
@@ -144,8 +241,7 @@ class GitHub(Client):
         self.labels = set()
         self.label_translations = self.config['label_translations']
         self._label_url = url = \
-            'https://api.github.com/repos/{repo}/labels?state=all'.\
-            format(repo=self.repo)
+            '{url}/labels?state=all'.format(url=self.url)
         while url:
             respo = self._expect_200(
                 self._api_call(self.session.get, url), url
@@ -177,7 +273,7 @@ class GitHub(Client):
         return labels
 
     def _create_label(self, name):
-        if self.options.dry_run:
+        if self.options.dry_run or self.options.verify:
             return
 
         respo = self._api_call(
@@ -202,7 +298,7 @@ class GitHub(Client):
         return number
 
     def _create_milestone(self, title):
-        if self.options.dry_run:
+        if self.options.dry_run or self.options.verify:
             return random.randint(1, 1000000)
 
         respo = self._api_call(
@@ -215,64 +311,16 @@ class GitHub(Client):
                 format(respo.status_code))
         return respo.json()["number"]
 
-    def _update_rate_limit(self, resp, *args, **kw):
-        now = time.time()
-        if self._rate_limit is None or now - self._rate_limit['last'] > 60:
-            self._rate_limit = {
-                "limit": int(resp.headers['X-RateLimit-Limit']),
-                "remaining": int(resp.headers['X-RateLimit-Remaining']),
-                "reset": int(resp.headers["X-RateLimit-Reset"]),
-                "last": time.time(),
-            }
-
-            if self._rate_limit["remaining"] <= 100:
-                print(
-                    "WARNING!  Only {} API calls left for the next {} "
-                    "seconds; going to wait that many seconds...".format(
-                        self._rate_limit["remaining"],
-                        self._rate_limit["reset"] - self._rate_limit["last"]
-                    )
-                )
-                seconds = self._rate_limit["reset"] - self._rate_limit["last"]
-                while seconds > 0:
-                    print("Sleeping....{} seconds remaining".format(seconds))
-                    time.sleep(30)
-                    seconds -= 30
-                print("OK done sleeping, let's hope it reset")
-                # return so the next API call will come back here and
-                # update rate limit again
-                return
-
-            self._rate_limit['rate_per_sec'] = (
-                self._rate_limit['remaining'] /
-                (self._rate_limit['reset'] - self._rate_limit['last'])
-            )
-
-            print(
-                "Refreshed github rate limit.  {} requests out "
-                "of {} remaining, until {} seconds from now.   Will run "
-                "API calls at {} requests per second".format(
-                    self._rate_limit['remaining'],
-                    self._rate_limit['limit'],
-                    self._rate_limit["reset"] - self._rate_limit["last"],
-                    self._rate_limit["rate_per_sec"]
-                ))
-
-    def _wait_for_api(self):
-        if self._rate_limit is None:
-            return
-        now = time.time()
-        if self._last_push_time:
-            time_passed = now - self._last_push_time
-            delay = 1 / self._rate_limit['rate_per_sec']
-            sleep_for = delay - time_passed
-            if sleep_for > 0:
-                time.sleep(sleep_for)
-        self._last_push_time = time.time()
-
     def _api_call(self, fn, url, *arg, **kw):
-        self._wait_for_api()
-        return fn(url, *arg, **kw)
+        # calls refused due to a rate limit are retried; the limiter
+        # has recorded how long to hold off from the response
+        for attempt in range(5):
+            self.rate_limiter.acquire()
+            respo = fn(url, *arg, **kw)
+            if not self.rate_limiter.is_rate_limited(respo):
+                break
+            print("Rate limited by GitHub on {}, retrying".format(url))
+        return respo
 
     def push_github_issue(self, issue, comments, verify_issue_id):
         """
@@ -289,10 +337,25 @@ class GitHub(Client):
             print("\nComments: ", comments)
             return
 
-        issue_data = {'issue': issue, 'comments': comments}
-        url = 'https://api.github.com/repos/{repo}/import/issues'.format(
-            repo=self.repo)
+        url, issue_data = self._start_import(issue, comments, verify_issue_id)
         push_respo = self._api_call(self.session.post, url, json=issue_data)
+        status_url = self._import_started(
+            issue, verify_issue_id, url, push_respo)
+        self.import_tracker.add(verify_issue_id, status_url)
+
+    def _start_import(self, issue, comments, verify_issue_id):
+        """Return the URL and data to POST to import an issue."""
+
+        if self.journal is not None:
+            self.journal.record(
+                verify_issue_id, hash=journal.payload_hash(issue, comments),
+                updated_at=_last_update(issue, comments),
+                closed=issue.get('closed', False))
+        url = '{url}/import/issues'.format(url=self.url)
+        return url, {'issue': issue, 'comments': comments}
+
+    def _import_started(self, issue, verify_issue_id, url, push_respo):
+        """Check the response to an import POST; return its status URL."""
         if push_respo.status_code == 422:
             raise RuntimeError(
                 "Initial import validation failed for issue '{}' due to the "
@@ -313,6 +376,8 @@ class GitHub(Client):
         # and the latter finishes before the former. For example, if the
         # former had a bunch more comments to be processed.
         # https://github.com/jeffwidman/bitbucket-issue-migration/issues/45
+        # With --import-window, that risk is taken deliberately for
+        # throughput, and the ImportTracker stops us as soon as it shows.
 
         # TODO: how this should also work is when we first start out, we
         # *retrieve* the issues FROM github first to see what the highest
@@ -320,44 +385,105 @@ class GitHub(Client):
         # parameter shouldn't be needed.
 
         status_url = push_respo.json()['url']
-        self._verify_github_issue_import_finished(verify_issue_id, status_url)
+        if self.journal is not None:
+            self.journal.record(
+                verify_issue_id, posted=time.time(), status_url=status_url)
+        return status_url
 
-    def _verify_github_issue_import_finished(
-            self, verify_issue_id, status_url):
+    def sync_github_issue(self, issue, comments, verify_issue_id):
         """
-        Check the status of a GitHub issue import.
+        Bring an already imported issue up to date with Bitbucket.
 
-        If the status is 'pending', it sleeps, then rechecks until the status
-        is either 'imported' or 'failed'.
+        The comments created since the issue was last pushed, as recorded
+        in the journal, are added, and the issue is closed or reopened if
+        its state changed.   The Import API only creates issues, so this
+        goes through the regular Issues API; the comments show up as
+        posted now, by the user the script logs in as.
         """
-        while True:
-            # note rate limiting is already slowing us down if needed,
-            # but for status checks we still need a slight delay between
-            # checks if the first one didn't go through
-            time.sleep(1)
-
-            respo = self._api_call(self.session.get, status_url)
-            if respo.status_code in (403, 404):
-                print(respo.status_code, "retrieving status URL", status_url)
-                respo.status_code == 404 and print(
-                    "GitHub sometimes inexplicably returns a 404 for the "
-                    "check url for a single issue even when the issue "
-                    "imports successfully. For details, see #77."
+        entry = self.journal.issues[verify_issue_id]
+        new_comments = sorted(
+            (comment for comment in comments
+             if comment['created_at'] > entry['updated_at']),
+            key=lambda comment: comment['created_at']
+        )
+        closed = issue.get('closed', False)
+        state_changed = closed != entry['closed']
+
+        if self.options.dry_run:
+            print("\nSync issue {}: ".format(verify_issue_id), issue)
+            print("\nNew comments: ", new_comments)
+            return
+
+        # the number GitHub gave the issue, if it told us when verified
+        issue_url = '{url}/issues/{number}'.format(
+            url=self.url, number=entry.get('number') or verify_issue_id)
+        for comment in new_comments:
+            url = issue_url + '/comments'
+            respo = self._api_call(
+                self.session.post, url, json={'body': comment['body']})
+            if respo.status_code != 201:
+                raise RuntimeError(
+                    "Failed to add a comment to issue {} due to "
+                    "unexpected HTTP status code: {}, url {}"
+                    .format(verify_issue_id, respo.status_code, url)
                 )
-                pprint.pprint(respo.headers)
-                return
+            # so that a sync cut short doesn't post the comment again
+            self.journal.record(
+                verify_issue_id, updated_at=comment['created_at'])
+
+        if state_changed:
+            respo = self._api_call(
+                self.session.patch, issue_url,
+                json={'state': 'closed' if closed else 'open'})
             if respo.status_code != 200:
                 raise RuntimeError(
-                    "Failed to check GitHub issue import status url: "
-                    "{} due to unexpected HTTP status code: {}"
-                    .format(status_url, respo.status_code)
+                    "Failed to change the state of issue {} due to "
+                    "unexpected HTTP status code: {}, url {}"
+                    .format(verify_issue_id, respo.status_code, issue_url)
                 )
-            status = respo.json()['status']
-            if status != 'pending':
-                break
 
-            print("Still waiting for verified status on {}...".format(
-                verify_issue_id))
+        self.journal.record(
+            verify_issue_id, updated_at=_last_update(issue, comments),
+            closed=closed, synced=time.time())
+        print("Synced issue {}: {} new comments{}".format(
+            verify_issue_id, len(new_comments),
+            (", closed" if closed else ", reopened") if state_changed
+            else ""))
+
+    def finish_imports(self):
+        """Wait for all issue imports still in progress to be verified."""
+        self.import_tracker.drain()
+
+    def _check_github_issue_import(self, verify_issue_id, status_url):
+        """
+        Check the status of a GitHub issue import once.
+
+        Returns False if the import is still 'pending', True if it is done,
+        and raises if it failed or the issue number doesn't match.
+        """
+        respo = self._api_call(self.session.get, status_url)
+        return self._import_checked(verify_issue_id, status_url, respo)
+
+    def _import_checked(self, verify_issue_id, status_url, respo):
+        if respo.status_code in (403, 404):
+            print(respo.status_code, "retrieving status URL", status_url)
+            respo.status_code == 404 and print(
+                "GitHub sometimes inexplicably returns a 404 for the "
+                "check url for a single issue even when the issue "
+                "imports successfully. For details, see #77."
+            )
+            pprint.pprint(respo.headers)
+            self._imported(verify_issue_id, None)
+            return True
+        if respo.status_code != 200:
+            raise RuntimeError(
+                "Failed to check GitHub issue import status url: "
+                "{} due to unexpected HTTP status code: {}"
+                .format(status_url, respo.status_code)
+            )
+        status = respo.json()['status']
+        if status == 'pending':
+            return False
 
         if status == 'imported':
             # Verify GH & BB issue IDs match.
@@ -367,29 +493,131 @@ class GitHub(Client):
             # - the GH repository has pre-existing pull requests
             #   (which it considers as issues)
             # - the Bitbucket repository has gaps in the numbering.
+            # - more than one import was in flight (--import-window) and
+            #   GitHub finished them out of order.
             json = respo.json()
             gh_issue_url = json['issue_url']
             gh_issue_id = int(gh_issue_url.split('/')[-1])
             if gh_issue_id != verify_issue_id:
-                raise Exception(
+                error = (
                     "Issues are out of sync, got github issue {} but "
                     "bitbucket issue is at {}".
                     format(gh_issue_id, verify_issue_id))
+                self._import_failed(verify_issue_id, error)
+                raise Exception(error)
             print("Imported Issue:", json['issue_url'])
+            self._imported(verify_issue_id, gh_issue_id)
         elif status == 'failed':
-            raise RuntimeError(
+            error = (
                 "Failed to import GitHub issue due to the following "
                 "errors:\n{}".format(respo.json())
             )
+            self._import_failed(verify_issue_id, error)
+            raise RuntimeError(error)
         else:
             raise RuntimeError(
                 "Status check for GitHub issue import returned unexpected "
                 "status: '{}'".format(status)
             )
+        return True
+
+    def _imported(self, verify_issue_id, number):
+        if self.journal is not None:
+            self.journal.record(
+                verify_issue_id, verified=time.time(), number=number)
+
+    def _import_failed(self, verify_issue_id, error):
+        # so that a restart POSTs the issue again, rather than checking
+        # the failed import over and over
+        if self.journal is not None:
+            self.journal.record(
+                verify_issue_id, failed=time.time(), error=error)
+
+
+def _last_update(issue, comments):
+    """Return the latest of when the issue was updated and its comments
+    were created, which is what new comments are told apart by.
+
+    >>> _last_update({'updated_at': '2012-01-02T00:00:00Z'},
+    ...              [{'created_at': '2012-03-04T00:00:00Z'}])
+    '2012-03-04T00:00:00Z'
+    """
+    return max(
+        [issue.get('updated_at') or ''] +
+        [comment['created_at'] for comment in comments]
+    )
+
+
+class ImportTracker:
+    """Tracks issue imports that were POSTed but aren't verified yet.
+
+    Up to ``window`` imports are allowed in flight; adding another one
+    waits until one of them is done.   Each round of checks looks at every
+    pending import, so a numbering mismatch raises as soon as GitHub
+    reports it rather than when its turn comes.
+
+    """
+
+    def __init__(self, gh, window):
+        self.gh = gh
+        self.window = max(window, 1)
+        self.pending = collections.OrderedDict()
+        self._added = {}
+        self._pending_seconds = gh.options.metrics.histogram(
+            "import_pending_seconds",
+            "Time from POSTing an issue import to verifying it.")
+
+    def add(self, verify_issue_id, status_url):
+        self.pending[verify_issue_id] = status_url
+        self._added[verify_issue_id] = time.time()
+        while len(self.pending) >= self.window:
+            self.poll()
+
+    def drain(self):
+        while self.pending:
+            self.poll()
+
+    def poll(self):
+        # note rate limiting is already slowing us down if needed,
+        # but for status checks we still need a slight delay between
+        # checks if the first one didn't go through
+        time.sleep(1)
+        for verify_issue_id, status_url in list(self.pending.items()):
+            if self.gh._check_github_issue_import(
+                    verify_issue_id, status_url):
+                del self.pending[verify_issue_id]
+                self._pending_seconds.observe(
+                    time.time() - self._added.pop(verify_issue_id))
+        if self.pending:
+            print("Still waiting for verified status on {}...".format(
+                ", ".join(str(issue_id) for issue_id in self.pending)))
 
 
 class AttachmentsRepo:
+    """A local clone of the GitHub wiki that attachments are added to.
+
+    Commits are pushed in batches: push() only pushes once
+    ``options.attachments_batch_issues`` issues have been committed, or the
+    oldest unpushed commit is ``options.attachments_batch_seconds`` old.
+    Issues linking to files in the wiki must not be pushed to GitHub while
+    ``unpushed`` is true.
+
+    With ``options.dedupe_attachments``, files are stored by the SHA-256 of
+    their content, as ``objects/<sha256>/<filename>``, so that a file
+    attached to many issues is stored once and linked from all of them.
+    Each link keeps the name the file was attached under; the same content
+    under another name is another path, but git still keeps a single blob.
+
+    """
+
     def __init__(self, repo, options):
+        self.batch_issues = options.attachments_batch_issues
+        self.batch_seconds = options.attachments_batch_seconds
+        self._unpushed = []
+        self._first_unpushed_time = None
+        self._bytes = options.metrics.counter(
+            "attachment_bytes_total",
+            "Bytes of attachments added to the wiki, before deduplication.")
 
         self.git_url = "ssh://git@github.com/{}.wiki.git".format(repo)
         self.dest = tempfile.mkdtemp()
@@ -401,50 +629,219 @@ class AttachmentsRepo:
             )
 
         print("Cloning {} into {}...".format(self.git_url, self.dest))
-        with self._chdir_as(self.dest):
-            self._run_cmd("git", "clone", self.git_url, "wiki_checkout")
-            self.repo_path = os.path.join(self.dest, "wiki_checkout")
-            if not os.path.exists(
-                    os.path.join(
-                        self.repo_path, "imported_issue_attachments")):
-                os.makedirs(
-                    os.path.join(self.repo_path, "imported_issue_attachments"))
+        self._run_cmd(
+            "git", "clone", self.git_url, "wiki_checkout", cwd=self.dest)
+        self.repo_path = os.path.join(self.dest, "wiki_checkout")
+        if not os.path.exists(
+                os.path.join(self.repo_path, "imported_issue_attachments")):
+            os.makedirs(
+                os.path.join(self.repo_path, "imported_issue_attachments"))
+
+        self.dedupe = options.dedupe_attachments
+        self._objects = set()
+        if self.dedupe:
+            self._load_objects()
+
+    def _load_objects(self):
+        """Find the deduplicated files stored by previous runs."""
+
+        objects_dir = os.path.join(
+            self.repo_path, "imported_issue_attachments", "objects")
+        if not os.path.isdir(objects_dir):
+            return
+        for digest in os.listdir(objects_dir):
+            for filename in os.listdir(os.path.join(objects_dir, digest)):
+                self._objects.add("objects/{}/{}".format(digest, filename))
 
     def add_attachment(self, issue_num, filename, content):
-        with self._chdir_as(self.repo_path, "imported_issue_attachments"):
-            if not os.path.exists(str(issue_num)):
-                os.makedirs(str(issue_num))
-            path = os.path.join(str(issue_num), filename)
-            with open(path, "wb") as out_:
-                out_.write(content)
-            self._run_cmd("git", "add", path)
-        return "../wiki/imported_issue_attachments/{}/{}".format(
-            issue_num, filename
+        """Add an attachment, returning the relative link to it.
+
+        content is a binary file object, or bytes.  It is copied in chunks
+        of CHUNK_SIZE, so large files aren't read into memory.
+
+        """
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.dest)
+        digest = hashlib.sha256() if self.dedupe else None
+        size = 0
+        with os.fdopen(fd, "wb") as out_:
+            for chunk in iter(lambda: content.read(CHUNK_SIZE), b""):
+                if digest is not None:
+                    digest.update(chunk)
+                out_.write(chunk)
+                size += len(chunk)
+        self._bytes.inc(size)
+
+        if self.dedupe:
+            path = "objects/{}/{}".format(digest.hexdigest(), filename)
+            if path in self._objects:
+                os.remove(tmp_path)
+            else:
+                self._objects.add(path)
+                self._store(path, tmp_path)
+        else:
+            path = "{}/{}".format(issue_num, filename)
+            self._store(path, tmp_path)
+        return "../wiki/imported_issue_attachments/{}".format(path)
+
+    def _store(self, path, tmp_path):
+        """Move the file at tmp_path into the wiki at path."""
+
+        attachments_path = os.path.join(
+            self.repo_path, "imported_issue_attachments")
+        dirname = os.path.join(attachments_path, os.path.dirname(path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        os.replace(tmp_path, os.path.join(attachments_path, path))
+        self._run_cmd("git", "add", path, cwd=attachments_path)
+
+    def commit(self, issue_num):
+        try:
+            self._run_cmd(
+                "git", "commit", "-m",
+                "Imported attachments for issue {}".format(issue_num),
+                cwd=self.repo_path)
+        except subprocess.CalledProcessError:
+            # HACK: for the moment, we aren't checking if the file
+            # is already there which means git commit returns
+            # a zero status code, just ignore
+            pass
+        self._committed(issue_num)
+
+    def _committed(self, issue_num):
+        if not self._unpushed:
+            self._first_unpushed_time = time.time()
+        self._unpushed.append(issue_num)
+
+    @property
+    def unpushed(self):
+        """True if there are commits that haven't been pushed yet."""
+        return bool(self._unpushed)
+
+    def push(self, force=False):
+        """Push the commits made so far, if a batch is due or force is set."""
+
+        if not self._unpushed:
+            return
+        if not force and len(self._unpushed) < self.batch_issues and (
+                not self.batch_seconds or
+                time.time() - self._first_unpushed_time < self.batch_seconds):
+            return
+        self._push()
+        self._unpushed[:] = []
+
+    def _push(self):
+        self._run_cmd("git", "push", cwd=self.repo_path)
+
+    def close(self):
+        pass
+
+    def _run_cmd(self, *args, cwd=None):
+        # commands run in the given directory rather than changing the
+        # working directory, as other threads of the migration go on
+        subprocess.check_call(args, cwd=cwd)
+
+
+class FastImportAttachmentsRepo(AttachmentsRepo):
+    """An AttachmentsRepo that writes through a single ``git fast-import``.
+
+    Attachments are streamed into the fast-import process as blobs and
+    committed directly to the checked out branch, rather than written to
+    the working tree and added with a ``git add`` per file.   The working
+    tree of the clone is left as it was; only the branch is pushed.
+
+    """
+
+    def __init__(self, repo, options):
+        super().__init__(repo, options)
+        self.branch = self._git_output("symbolic-ref", "HEAD")
+        name_email, _, _ = self._git_output(
+            "var", "GIT_COMMITTER_IDENT").rpartition(">")
+        self.committer = name_email + ">"
+        self._from = "{}^0".format(self.branch)
+        self._marks = 0
+        self._files = []
+        self._fast_import = subprocess.Popen(
+            ["git", "fast-import", "--quiet"], cwd=self.repo_path,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
         )
 
+    def _git_output(self, *args):
+        return subprocess.check_output(
+            ("git", ) + args, cwd=self.repo_path).decode("utf-8").strip()
+
+    def _write(self, *chunks):
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            self._fast_import.stdin.write(chunk)
+
+    def _store(self, path, tmp_path):
+        self._marks += 1
+        self._write("blob\nmark :{}\ndata {}\n".format(
+            self._marks, os.path.getsize(tmp_path)))
+        with open(tmp_path, "rb") as file_:
+            for chunk in iter(lambda: file_.read(CHUNK_SIZE), b""):
+                self._write(chunk)
+        self._write("\n")
+        os.remove(tmp_path)
+        self._files.append(
+            ("imported_issue_attachments/{}".format(path), self._marks))
+
     def commit(self, issue_num):
-        with self._chdir_as(self.repo_path):
-            try:
-                self._run_cmd(
-                    "git", "commit", "-m",
-                    "Imported attachments for issue {}".format(issue_num))
-            except subprocess.CalledProcessError:
-                # HACK: for the moment, we aren't checking if the file
-                # is already there which means git commit returns
-                # a zero status code, just ignore
-                pass
-
-    def push(self):
-        with self._chdir_as(self.repo_path):
-            self._run_cmd("git", "push")
-
-    @contextlib.contextmanager
-    def _chdir_as(self, *path_tokens):
-        currdir = os.getcwd()
-        path = os.path.join(*path_tokens)
-        os.chdir(path)
-        yield
-        os.chdir(currdir)
-
-    def _run_cmd(self, *args):
-        subprocess.check_call(args)
+        if not self._files:
+            return
+        message = "Imported attachments for issue {}".format(
+            issue_num).encode("utf-8")
+        self._write(
+            "commit {}\n".format(self.branch),
+            "committer {} {} +0000\n".format(
+                self.committer, int(time.time())),
+            "data {}\n".format(len(message)), message, "\n"
+        )
+        if self._from:
+            self._write("from {}\n".format(self._from))
+            self._from = None
+        for path, mark in self._files:
+            self._write("M 100644 :{} {}\n".format(mark, _quote_path(path)))
+        self._write("\n")
+        self._files[:] = []
+        self._committed(issue_num)
+
+    def _push(self):
+        # have fast-import write out the branch, and wait for it to
+        # say it's done before pushing
+        self._write("checkpoint\nprogress checkpoint\n")
+        self._fast_import.stdin.flush()
+        while True:
+            line = self._fast_import.stdout.readline()
+            if not line:
+                raise RuntimeError("git fast-import exited unexpectedly")
+            if line.strip() == b"progress checkpoint":
+                break
+        super()._push()
+
+    def close(self):
+        self._fast_import.stdin.close()
+        if self._fast_import.wait() != 0:
+            raise RuntimeError(
+                "git fast-import failed with status {}".format(
+                    self._fast_import.returncode))
+
+
+def _quote_path(path):
+    """Quote a path for a git fast-import command if needed.
+
+    >>> _quote_path("a/b c.txt")
+    'a/b c.txt'
+    >>> _quote_path('a/"b".txt')
+    '"a/\\\\"b\\\\".txt"'
+    """
+    if '"' not in path and "\n" not in path and "\\" not in path:
+        return path
+    return '"{}"'.format(
+        path.replace("\\", "\\\\").replace('"', '\\"').
+        replace("\n", "\\n")
+    )
@@ -0,0 +1,142 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import threading
+
+
+class Journal:
+    """Append-only record of the progress of each issue.
+
+    Every step of pushing an issue appends a line of JSON with the
+    fields it learned, and is flushed to disk before the migration goes
+    on, so that a restarted migration knows exactly which issues were
+    imported and which imports were still in progress:
+
+    * ``hash`` - hash of the converted issue, written before it's POSTed
+    * ``updated_at``, ``closed`` - the latest time the issue was updated
+      or commented on, and whether it was closed, as of the last time it
+      was pushed or synced with --delta
+    * ``posted``, ``status_url`` - time of the POST and the URL to check
+      the import status at
+    * ``verified``, ``number`` - time the import was verified, and the
+      GitHub issue number it got, if GitHub told us
+    * ``failed``, ``error`` - time GitHub reported the import as failed,
+      or as given another issue number, and what it said; the issue is
+      then POSTed again once the offset is detected from GitHub
+    * ``synced`` - time the issue was last synced with --delta
+
+    The entries of an issue are merged into one dictionary in ``issues``.
+    A partly written last line, as left by a crash, is ignored.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "journal")
+    >>> journal = Journal(path)
+    >>> journal.record(1, posted=1.0, status_url="/1")
+    >>> journal.record(1, verified=2.0, number=1)
+    >>> journal.record(2, posted=3.0, status_url="/2")
+    >>> journal.record(2, failed=4.0, error="import failed")
+    >>> journal.close()
+    >>> journal = Journal(path)
+    >>> journal.pending(), journal.unposted(), journal.offset()
+    ([], [2], 1)
+    >>> journal.record(2, posted=5.0, status_url="/2b")
+    >>> journal.pending(), journal.unposted()
+    ([(2, '/2b')], [])
+    >>> journal.close()
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.issues = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, "a")
+
+    def _load(self):
+        with open(self.path, "rb+") as file_:
+            end = 0
+            for line in file_:
+                if not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                entry = json.loads(line.decode("utf-8"))
+                self.issues.setdefault(entry.pop("issue"), {}).update(entry)
+            # drop the partly written line, so the next entry starts
+            # on a line of its own
+            file_.truncate(end)
+
+    def record(self, issue_id, **fields):
+        with self._lock:
+            self.issues.setdefault(issue_id, {}).update(fields)
+            fields["issue"] = issue_id
+            self.file.write(json.dumps(fields, sort_keys=True) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def pending(self):
+        """Return ``(issue_id, status_url)`` for unverified imports."""
+        return [
+            (issue_id, entry["status_url"])
+            for issue_id, entry in sorted(self.issues.items())
+            if "status_url" in entry and "verified" not in entry
+            and not _failed(entry)
+        ]
+
+    def unposted(self):
+        """Return the ids of issues that may or may not have been POSTed.
+
+        These were about to be POSTed when the migration stopped, so only
+        GitHub knows whether they made it.   Issues whose import failed
+        are included, so that they're POSTed again.
+
+        """
+        return sorted(
+            issue_id for issue_id, entry in self.issues.items()
+            if "posted" not in entry or _failed(entry)
+        )
+
+    def offset(self):
+        """Return the highest issue id whose import was verified."""
+        return max(
+            (issue_id for issue_id, entry in self.issues.items()
+             if "verified" in entry),
+            default=0
+        )
+
+    def close(self):
+        self.file.close()
+
+
+def _failed(entry):
+    """Return whether the last import of an issue failed, rather than
+    having been POSTed again since."""
+    return "failed" in entry and entry["failed"] >= entry.get("posted", 0)
+
+
+def payload_hash(issue, comments):
+    """Return a hash of the data POSTed to import an issue.
+
+    >>> payload_hash({"title": "t"}, []) == payload_hash({"title": "t"}, [])
+    True
+    """
+    payload = json.dumps(
+        {"issue": issue, "comments": comments}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -0,0 +1,138 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental parsing of a large JSON document.
+
+Only the layout of the Bitbucket export is supported, that is a
+top level object whose interesting values are arrays of records.   Each
+record is decoded on its own, so the whole document is never in memory
+at once.
+
+"""
+
+import io
+import json
+import re
+
+_WS = re.compile(r"[ \t\n\r]*")
+_NUMBER_CHARS = re.compile(r"[0-9eE.+-]*")
+
+
+class _Reader:
+    def __init__(self, file_, chunk_size):
+        self.file = file_
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        if self.eof:
+            return False
+        chunk = self.file.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                "Expected {!r} at position {} of the buffer, got {!r}".format(
+                    char, self.pos, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # most likely the value is cut off at the end of the
+                # buffer; read more, increasing the read size so that
+                # very large values don't get re-parsed too many times
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+
+            # a number at the end of the buffer may continue in
+            # the next chunk
+            if _NUMBER_CHARS.match(self.buf, end).end() == len(self.buf) \
+                    and self._fill(size):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_arrays(file_, chunk_size=65536):
+    """Yield ``(key, item)`` for each item in the top level arrays.
+
+    ``file_`` is a binary or text file containing a JSON object; values
+    of the object that aren't arrays are parsed and skipped.
+
+    >>> doc = b'{"issues": [{"id": 1}, {"id": 2}], "meta": {"a": 1}, '
+    >>> doc += b'"logs": [], "comments": [3]}'
+    >>> for key, item in iter_arrays(io.BytesIO(doc), chunk_size=4):
+    ...     print(key, item)
+    issues {'id': 1}
+    issues {'id': 2}
+    comments 3
+    """
+
+    if not isinstance(file_, io.TextIOBase):
+        file_ = io.TextIOWrapper(file_, encoding="utf-8")
+
+    reader = _Reader(file_, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        key = reader.decode()
+        reader.expect(":")
+        if reader.peek() == "[":
+            reader.pos += 1
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield key, reader.decode()
+                    if reader.peek() == ",":
+                        reader.pos += 1
+                    else:
+                        reader.expect("]")
+                        break
+        else:
+            reader.decode()
+
+        if reader.peek() == ",":
+            reader.pos += 1
+        else:
+            reader.expect("}")
+            break
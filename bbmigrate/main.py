@@ -15,18 +15,30 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import collections
+import concurrent.futures
+import multiprocessing
 import queue
+import sys
 import threading
 import time
 
 import yaml
 
+from . import aio
 from . import base
 from . import convert
+from . import metrics
+from . import spool
 from .bitbucket import Bitbucket
 from .bitbucket import BitbucketExport
 from .github import AttachmentsRepo
+from .github import FastImportAttachmentsRepo
 from .github import GitHub
+from .journal import Journal
+from .profiling import Profiler
+from .usercache import UserCache
+from .verify import Verifier
 
 
 def _read_arguments(argv):
@@ -39,7 +51,8 @@ def _read_arguments(argv):
         help=(
             "Bitbucket repository to pull issues from.\n"
             "Format: <user or organization name>/<repo name>\n"
-            "or path to export zipfile"
+            "or path to export zipfile\n"
+            "or path to a spool file written with --compile-to\n"
             "Example: jeffwidman/bitbucket-issue-migration\n"
             "Example: /path/to/export.zip"
         )
@@ -79,6 +92,16 @@ def _read_arguments(argv):
         )
     )
 
+    parser.add_argument(
+        "--offline", action="store_true",
+        help=(
+            "Don't look up users on Bitbucket or GitHub; users are only "
+            "linked to GitHub when mapped with --map-user.  With --dry-run, "
+            "GitHub isn't contacted at all either, and the GitHub repo is "
+            "taken to be empty.  Requires an export zipfile or spool file."
+        )
+    )
+
     parser.add_argument(
         "-f", "--skip", type=int, default=0,
         help=(
@@ -90,6 +113,78 @@ def _read_arguments(argv):
         )
     )
 
+    parser.add_argument(
+        "--github-api-url", type=str, default=base.GITHUB_API_URL,
+        metavar="URL",
+        help=(
+            "Base URL of the GitHub API, for example that of a server "
+            "started with \"python -m bbmigrate.standin\" to try out a "
+            "migration locally.  Defaults to {}.".format(base.GITHUB_API_URL)
+        )
+    )
+
+    parser.add_argument(
+        "--journal", type=str, metavar="PATH",
+        help=(
+            "Path to a file in which the progress of every issue is "
+            "recorded as it's pushed.   A restarted migration using the "
+            "same journal resumes right after the last imported issue, and "
+            "first finishes verifying the imports that were in progress."
+        )
+    )
+
+    parser.add_argument(
+        "--delta", action="store_true",
+        help=(
+            "Rather than importing issues, catch up issues that were "
+            "already migrated with the comments and state changes made on "
+            "Bitbucket since, as recorded in the --journal.  Only the "
+            "issues updated since they were pushed are read, and the "
+            "additions go through the regular GitHub Issues API.  "
+            "Attachments aren't migrated."
+        )
+    )
+
+    parser.add_argument(
+        "--verify", action="store_true",
+        help=(
+            "Rather than migrating, compare the issues of the GitHub "
+            "repository with those of the source, and report the ones "
+            "whose title, state, number of comments or labels don't "
+            "match.  Pass the same options that the migration was run "
+            "with, such as --mention-changes, so that the issues are "
+            "converted the same way."
+        )
+    )
+
+    parser.add_argument(
+        "--verify-pages", type=int, default=10, metavar="PAGES",
+        help=(
+            "Number of pages of 100 GitHub issues fetched at once by "
+            "--verify.  Defaults to 10."
+        )
+    )
+
+    parser.add_argument(
+        "--stream-export", action="store_true",
+        help=(
+            "When migrating from an export zipfile, stream the export into "
+            "a temporary on-disk index rather than loading it into memory. "
+            "Use this for very large exports."
+        )
+    )
+
+    parser.add_argument(
+        "--compile-to", type=str, metavar="PATH",
+        help=(
+            "Convert the issues and write them to a spool file ending in "
+            "{0}, instead of pushing them.  Passing the spool file in place "
+            "of the Bitbucket repository then pushes the converted issues "
+            "from it, without reading or converting anything again."
+            .format(spool.SUFFIX)
+        )
+    )
+
     parser.add_argument(
         "-m", "--map-user", action="append", dest="_map_users", default=[],
         help=(
@@ -126,6 +221,45 @@ def _read_arguments(argv):
         )
     )
 
+    parser.add_argument(
+        "--attachments-batch-issues", type=int, default=1, metavar="ISSUES",
+        help=(
+            "When using the --attachments-wiki option, push the wiki after "
+            "this many issues with attachments have been committed.  Issues "
+            "are held back from GitHub until the attachments they link to "
+            "have been pushed, and kept in memory meanwhile, along with "
+            "the issues without attachments that follow them; the wiki is "
+            "pushed early once --queue-size issues are held.  Defaults to 1."
+        )
+    )
+
+    parser.add_argument(
+        "--attachments-batch-seconds", type=float, default=0,
+        metavar="SECONDS",
+        help=(
+            "When using the --attachments-wiki option, also push the wiki "
+            "once the oldest unpushed commit is this many seconds old."
+        )
+    )
+
+    parser.add_argument(
+        "--dedupe-attachments", action="store_true",
+        help=(
+            "When using the --attachments-wiki option, store each distinct "
+            "attachment content only once in the wiki, and link every issue "
+            "that has it under the same name to the same file."
+        )
+    )
+
+    parser.add_argument(
+        "--attachments-fast-import", action="store_true",
+        help=(
+            "When using the --attachments-wiki option, commit attachments "
+            "to the wiki through a single git fast-import process instead "
+            "of running git add and git commit for each issue."
+        )
+    )
+
     parser.add_argument(
         "--git-ssh-identity", type=str,
         help=(
@@ -134,11 +268,159 @@ def _read_arguments(argv):
         )
     )
 
+    parser.add_argument(
+        "--import-window", type=int, default=1, metavar="ISSUES",
+        help=(
+            "Number of issue imports that may be in progress on GitHub at "
+            "once.  The default of 1 waits for each issue to be imported "
+            "before sending the next one.  GitHub may finish imports out "
+            "of order; if the issue numbers come out wrong the migration "
+            "stops immediately."
+        )
+    )
+
     parser.add_argument(
         "--mention-changes", action="store_true",
         help="Mention changes in status as comments.",
     )
 
+    parser.add_argument(
+        "--http-pool-size", type=int, default=10,
+        help=(
+            "Number of keep-alive connections kept open to the Bitbucket "
+            "API.  With --engine asyncio, this is also the most Bitbucket "
+            "API calls made at a time, so raise it along with --lookahead "
+            "and --prefetch-users; GitHub calls are made over as many "
+            "connections as --import-window or --prefetch-users allow.  "
+            "Defaults to 10."
+        )
+    )
+
+    parser.add_argument(
+        "--http-retries", type=int, default=3,
+        help=(
+            "Number of times a failed Bitbucket API call is retried.  "
+            "Defaults to 3."
+        )
+    )
+
+    parser.add_argument(
+        "--lookahead", type=int, default=0, metavar="ISSUES",
+        help=(
+            "Fetch the comments, changes and attachment lists for this "
+            "many issues ahead of the one being converted, in parallel. "
+            "Mostly useful when migrating from the Bitbucket API."
+        )
+    )
+
+    parser.add_argument(
+        "--engine", choices=("threads", "asyncio"), default="threads",
+        help=(
+            "How API calls are made concurrently.  With asyncio, fetching "
+            "from the Bitbucket API for --lookahead, --prefetch-users "
+            "lookups and import status checks for --import-window run as "
+            "coroutines on one event loop instead of in threads, so "
+            "hundreds of them can be in flight at little cost.  Requires "
+            "aiohttp.  Defaults to threads."
+        )
+    )
+
+    parser.add_argument(
+        "--queue-size", type=int, default=20, metavar="ISSUES",
+        help=(
+            "Number of issues buffered between each stage of the "
+            "migration: reading issues, fetching their comments and "
+            "changes, adding attachments, converting and pushing.  When "
+            "a stage falls behind, the stages before it wait, so memory "
+            "use stays flat.  Defaults to 20."
+        )
+    )
+
+    parser.add_argument(
+        "--convert-processes", type=int, default=0, metavar="PROCESSES",
+        help=(
+            "Convert the markup of issues and comments in this many "
+            "processes, to make use of several cores when converting a "
+            "large export."
+        )
+    )
+
+    parser.add_argument(
+        "--prefetch-users", type=int, default=0, metavar="THREADS",
+        help=(
+            "Look up every user referenced by the export before converting "
+            "any issues, using this many threads, or this many concurrent "
+            "lookups with --engine asyncio.  Only supported when "
+            "migrating from an export zipfile."
+        )
+    )
+
+    parser.add_argument(
+        "--user-cache", type=str,
+        help=(
+            "Path to a file in which Bitbucket and GitHub user lookups are "
+            "cached between runs, so that a restarted migration doesn't "
+            "need to look up the same users again."
+        )
+    )
+
+    parser.add_argument(
+        "--user-cache-ttl", type=float, default=30,
+        help=(
+            "Number of days a user lookup is kept in the --user-cache. "
+            "Defaults to 30."
+        )
+    )
+
+    parser.add_argument(
+        "--user-cache-negative-ttl", type=float, default=1,
+        help=(
+            "Number of days a lookup for a user that doesn't exist is kept "
+            "in the --user-cache.  Defaults to 1."
+        )
+    )
+
+    parser.add_argument(
+        "--metrics-port", type=int, metavar="PORT",
+        help=(
+            "Serve metrics of the migration, such as API calls, latencies "
+            "and conversion times, on this port in the Prometheus text "
+            "format."
+        )
+    )
+
+    parser.add_argument(
+        "--metrics-file", type=str, metavar="PATH",
+        help=(
+            "Write metrics of the migration to this JSON file every "
+            "--metrics-interval seconds, and when the migration ends."
+        )
+    )
+
+    parser.add_argument(
+        "--metrics-interval", type=float, default=60, metavar="SECONDS",
+        help="How often to write the --metrics-file.  Defaults to 60."
+    )
+
+    parser.add_argument(
+        "--profile", type=str, metavar="DIR",
+        help=(
+            "Profile each stage of the migration separately with "
+            "cProfile, or by sampling on Python 3.12 and later: reading "
+            "issues, fetching their comments and changes, adding "
+            "attachments, converting markup with --convert-processes, "
+            "converting and queuing issues (the producer) and pushing "
+            "them.  The profiles are saved in this "
+            "directory, and the functions taking the most time in each "
+            "are printed at exit."
+        )
+    )
+
+    parser.add_argument(
+        "--profile-top", type=int, default=20, metavar="N",
+        help="Number of functions printed per profile.  Defaults to 20."
+    )
+
     parser.add_argument(
         "--use-config", type=str,
         default="config.yml",
@@ -155,64 +437,221 @@ def main(argv=None):
     options = _read_arguments(argv)
 
     with open(options.use_config, "r") as file_:
-        config = yaml.load(file_)
+        config = convert.Config(yaml.safe_load(file_))
+
+    # the main thread converts issues, and the other stages run in
+    # threads of their own; each is profiled separately
+    profiler = Profiler(options.profile, options.profile_top)
+    try:
+        profiler.wrap("producer", _migrate)(options, config, profiler)
+    finally:
+        profiler.report()
+
+
+def _migrate(options, config, profiler):
+    if options.delta and not options.journal:
+        raise TypeError("Option --delta requires --journal")
+
+    options.metrics = metrics.Registry()
+    if options.metrics_port:
+        metrics.serve(options.metrics, options.metrics_port)
+    if options.metrics_file:
+        dumper = metrics.JSONDumper(
+            options.metrics, options.metrics_file, options.metrics_interval)
+        dumper.start()
+
+    if options.journal:
+        options.journal = Journal(options.journal)
+
+    try:
+        _migrate_issues(options, config, profiler)
+    finally:
+        # also when the migration fails or is interrupted, which is when
+        # the journal and the last metrics are needed the most
+        if options.journal:
+            options.journal.close()
+        if options.metrics_file:
+            dumper.stop()
+
+
+def _migrate_issues(options, config, profiler):
+    if options.user_cache:
+        options.user_cache = UserCache(
+            options.user_cache,
+            ttl=options.user_cache_ttl * 86400,
+            negative_ttl=options.user_cache_negative_ttl * 86400
+        )
 
-    if options.bitbucket_repo.endswith(".zip"):
+    if options.delta:
+        # only new comments and state changes are synced, which don't
+        # link the attachments, so there's no need to add them to the wiki
+        options.attachments_wiki = options.mention_attachments = False
+
+    if options.verify:
+        if options.delta or options.compile_to or options.dry_run:
+            raise TypeError(
+                "Option --verify can't be used with --delta, --compile-to "
+                "or --dry-run")
+        # issue bodies aren't compared, so there's no need to look at
+        # the attachments
+        options.attachments_wiki = options.mention_attachments = False
+
+    if options.engine == "asyncio":
+        options.aio = aio.Engine(options)
+    else:
+        options.aio = None
+
+    from_spool = spool.is_spool(options.bitbucket_repo)
+    if from_spool:
+        if options.compile_to or options.delta:
+            raise TypeError(
+                "Options --compile-to and --delta can't be used when "
+                "pushing from a spool file")
+        bb = None
+    elif options.bitbucket_repo.endswith(".zip"):
         bb = BitbucketExport(config, options)
+    elif options.offline:
+        raise TypeError(
+            "Option --offline requires an export zipfile or spool file")
     else:
         bb = Bitbucket(config, options)
 
-    gh = GitHub(config, options)
+    # user lookups while converting go through the same session
+    options.gh = gh = GitHub(config, options)
+
+    abort_event = threading.Event()
+    worker_errors = []
+
+    if options.compile_to:
+        if options.delta:
+            raise TypeError(
+                "Options --compile-to and --delta are mutually exclusive")
+        # converted issues go to the spool instead of being pushed
+        work_queue = spool.SpoolWriter(options.compile_to)
+        worker_thread = None
+    else:
+        work_queue = queue.Queue(options.queue_size)
+        if options.verify:
+            verifier = Verifier(gh, options, options.verify_pages)
+            push, finish = verifier.check_issue, verifier.finish
+        elif options.delta:
+            push, finish = gh.sync_github_issue, None
+        else:
+            if options.aio and not options.dry_run:
+                pusher = aio.AsyncGitHub(gh, options.aio)
+            else:
+                pusher = gh
+            push, finish = pusher.push_github_issue, pusher.finish_imports
+        worker_thread = threading.Thread(
+            target=profiler.wrap("push", push_issues),
+            args=(abort_event, work_queue, push, finish, worker_errors)
+        )
+        worker_thread.daemon = True
+        worker_thread.start()
+        options.metrics.gauge(
+            "work_queue_depth", "Issues waiting to be pushed.",
+            fn=work_queue.qsize)
+
+    try:
+        if from_spool:
+            print("getting issues from spool file")
+            for item in spool.read(options.bitbucket_repo, options.skip):
+                if abort_event.is_set():
+                    break
+                work_queue.put(item)
+        else:
+            _queue_issues(
+                bb, gh, config, options, abort_event, work_queue, profiler)
+    except BaseException:
+        abort_event.set()
+        raise
+    finally:
+        if worker_thread is None:
+            work_queue.close()
+        else:
+            # None tells the worker there are no more issues
+            work_queue.put(None)
+            worker_thread.join()
+        if options.aio:
+            options.aio.close()
+    if worker_errors:
+        raise worker_errors[0]
+
+
+def _queue_issues(
+        bb, gh, config, options, abort_event, work_queue, profiler):
+    """Convert the issues from Bitbucket and put them on the work queue."""
 
     if options.attachments_wiki:
         if options.mention_attachments:
             raise TypeError(
                 "Options --mention-attachments and --attachments-wiki are "
                 "mutually exclusive")
-        attachments_repo = AttachmentsRepo(options.github_repo, options)
+        if options.attachments_fast_import:
+            attachments_repo = FastImportAttachmentsRepo(
+                options.github_repo, options)
+        else:
+            attachments_repo = AttachmentsRepo(options.github_repo, options)
+    else:
+        attachments_repo = None
+
+    if options.prefetch_users:
+        if not isinstance(bb, BitbucketExport):
+            raise TypeError(
+                "Option --prefetch-users requires an export zipfile")
+        if options.aio:
+            aio.prefetch_users(bb, gh, options, options.prefetch_users)
+        else:
+            convert.prefetch_users(bb, options, options.prefetch_users)
 
     print("getting issues from bitbucket")
-    issues_iterator = base.fill_gaps(bb.get_issues(options.skip), options.skip)
+    if options.delta:
+        issues_iterator = _updated_issues(bb.get_issues(0), options.journal)
+    else:
+        issues_iterator = base.fill_gaps(
+            bb.get_issues(options.skip), options.skip)
+
+    # each stage runs in a thread of its own, so that reading, fetching
+    # and adding attachments go on while issues are converted and pushed
+    items = _stage(
+        issues_iterator, abort_event, options.queue_size,
+        profiler, "read")
+    items = _stage(
+        _fetch_issues(bb, items, options), abort_event, options.queue_size,
+        profiler, "fetch",
+        tick=attachments_repo and options.attachments_batch_seconds or None)
+    items = _stage(
+        _process_attachments(bb, items, options, attachments_repo),
+        abort_event, options.queue_size, profiler, "attachments")
+    if options.convert_processes:
+        items = _stage(
+            _convert_contents(items, options),
+            abort_event, options.queue_size, profiler, "markup")
+    else:
+        items = ((item, None) for item in items)
 
-    abort_event = threading.Event()
+    convert_seconds = options.metrics.histogram(
+        "convert_issue_seconds",
+        "Time taken to convert an issue with its comments and changes.")
 
-    work_queue = queue.Queue()
-    worker_thread = threading.Thread(
-        target=push_issues,
-        args=(abort_event, work_queue, gh)
-    )
-    worker_thread.daemon = True
-    worker_thread.start()
-
-    for index, issue in enumerate(issues_iterator):
+    for (issue, comments, changes, attachment_links), contents in items:
         if abort_event.is_set():
             break
+        started = time.time()
 
-        if isinstance(issue, base.DummyIssue):
-            comments = []
-            changes = []
-            attachment_links = []
-        else:
-            comments = bb.get_issue_comments(issue['id'])
-            changes = bb.get_issue_changes(issue['id'])
-
-            if options.attachments_wiki:
-                attachment_links = convert.process_wiki_attachments(
-                    issue['id'], bb, options, attachments_repo
-                )
-            elif options.mention_attachments:
-                attachment_links = convert.get_attachment_names(
-                    issue['id'], bb)
-            else:
-                attachment_links = []
+        comments_with_content = [
+            c for c in comments if c['content']['raw'] is not None
+        ]
+        if contents is None:
+            contents = [None] * (1 + len(comments_with_content))
 
         gh_issue = convert.convert_issue(
             issue, comments, changes,
-            options, attachment_links, gh, config
+            options, attachment_links, gh, config, content=contents[0]
         )
         gh_comments = [
-            convert.convert_comment(c, options, config) for c in comments
-            if c['content']['raw'] is not None
+            convert.convert_comment(c, options, config, content=content)
+            for c, content in zip(comments_with_content, contents[1:])
         ]
 
         if options.mention_changes and changes:
@@ -235,33 +674,265 @@ def main(argv=None):
             )
 
         convert._zzzeeks_specific_milestone_fixer(gh, gh_issue, gh_comments)
+        convert_seconds.observe(time.time() - started)
 
         print("Queuing bitbucket issue {} for export".format(issue['id']))
         work_queue.put((issue['id'], gh_issue, gh_comments))
 
-    # can't use queue.join() because if a worker gets a 403 we need
-    # to break out
-    while work_queue.qsize() != 0 and not abort_event.is_set():
-        time.sleep(3)
-    abort_event.set()
-    worker_thread.join()
 
+def _updated_issues(issues, journal):
+    """Yield the issues updated on Bitbucket since they were pushed."""
+
+    for issue in issues:
+        entry = journal.issues.get(issue['id'], {})
+        if "verified" not in entry or "updated_at" not in entry:
+            print(
+                "Skipping bitbucket issue {}, which the journal doesn't "
+                "have as imported".format(issue['id']))
+        elif convert.convert_date(issue['updated_on']) > entry['updated_at']:
+            yield issue
+
+
+def _fetch_issue_resources(bb, issue, options):
+    """Fetch the comments, changes and attachment list of an issue."""
+
+    if isinstance(issue, base.DummyIssue):
+        return [], [], []
+
+    comments = bb.get_issue_comments(issue['id'])
+    changes = bb.get_issue_changes(issue['id'])
+    if options.attachments_wiki or options.mention_attachments:
+        bb_attachments = bb.get_attachments(issue['id'])
+    else:
+        bb_attachments = []
+    return comments, changes, bb_attachments
+
+
+def _fetch_issues(bb, issues_iterator, options):
+    """Yield ``(issue, comments, changes, bb_attachments)`` per issue."""
+
+    if options.aio and isinstance(bb, Bitbucket):
+        # fetch on the event loop; up to --lookahead issues are in
+        # flight at once
+        async_bb = aio.AsyncBitbucket(bb, options.aio)
+        results = _in_order(
+            issues_iterator,
+            lambda issue: options.aio.submit(
+                async_bb.fetch_issue_resources(issue, options)),
+            options.lookahead)
+    else:
+        def fetch(issue):
+            return _fetch_issue_resources(bb, issue, options)
+        results = _lookahead(issues_iterator, fetch, options.lookahead)
+
+    for issue, (comments, changes, bb_attachments) in results:
+        yield issue, comments, changes, bb_attachments
+
+
+def _process_attachments(bb, items, options, attachments_repo):
+    """Yield ``(issue, comments, changes, attachment_links)`` per issue.
+
+    With --attachments-wiki, the attachments are added to the wiki, and
+    when its pushes are batched, issues are held back until the wiki
+    commits they may link to have been pushed.   Issues without
+    attachments are held too, to keep the issues in order; once
+    --queue-size issues are held, the wiki is pushed early, so that no
+    more than that are kept in memory.
+
+    items may yield None when the issues are slow to come, see _stage(),
+    so that the --attachments-batch-seconds deadline is still kept.
+
+    """
+    held = []
+    for item in items:
+        if item is None:
+            if held:
+                attachments_repo.push()
+                if not attachments_repo.unpushed:
+                    yield from held
+                    held[:] = []
+            continue
+        issue, comments, changes, bb_attachments = item
+        if isinstance(issue, base.DummyIssue):
+            attachment_links = []
+        elif options.attachments_wiki:
+            attachment_links = convert.process_wiki_attachments(
+                issue['id'], bb, options, attachments_repo, bb_attachments
+            )
+        elif options.mention_attachments:
+            attachment_links = convert.get_attachment_names(
+                issue['id'], bb, bb_attachments)
+        else:
+            attachment_links = []
+        item = (issue, comments, changes, attachment_links)
+
+        if attachments_repo is None:
+            yield item
+            continue
+        held.append(item)
+        attachments_repo.push(force=len(held) >= options.queue_size)
+        if not attachments_repo.unpushed:
+            yield from held
+            held[:] = []
+
+    if attachments_repo is not None:
+        attachments_repo.push(force=True)
+        attachments_repo.close()
+        yield from held
+
+
+def _convert_contents(items, options):
+    """Yield ``(item, contents)`` for the items from _process_attachments().
+
+    The content of each issue and its comments is converted in a pool of
+    processes; contents is the list of converted texts, the issue first.
+
+    """
+
+    def submit(item):
+        issue, comments = item[0:2]
+        raw_contents = [
+            None if isinstance(issue, base.DummyIssue)
+            else issue['content']['raw']
+        ]
+        raw_contents.extend(
+            c['content']['raw'] for c in comments
+            if c['content']['raw'] is not None
+        )
+        return executor.submit(convert.convert_contents, raw_contents)
+
+    # the stage, push and metrics threads are running by now, and forking
+    # while one of them holds a lock can leave the lock held for good in
+    # the workers; spawned workers get all they need from initargs
+    with concurrent.futures.ProcessPoolExecutor(
+            options.convert_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=convert.init_contents_worker,
+            initargs=(convert.contents_options(options), )) as executor:
+        yield from _in_order(items, submit, options.convert_processes * 4)
+
+
+class _StageEnd:
+    def __init__(self, error):
+        self.error = error
 
-def push_issues(abort, work_queue, gh):
-    while not abort.is_set():
+
+def _stage(iterator, abort_event, maxsize, profiler, name, tick=None):
+    """Run the iterator in a thread of its own, and yield its items.
+
+    The thread is profiled as the stage name.
+
+    Up to maxsize items are kept ready ahead of the consumer; beyond
+    that, the thread waits for the consumer to catch up.   An error in
+    the thread is raised in the consumer.
+
+    With tick, None is yielded whenever no item has come for that many
+    seconds, so that the consumer can get on with time based work.
+
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def run():
+        error = None
         try:
-            issue_id, gh_issue, gh_comments = work_queue.get(timeout=3)
-        except queue.Empty:
-            if abort.is_set():
-                break
-            else:
+            for item in iterator:
+                if stopped.is_set():
+                    return
+                if abort_event.is_set():
+                    break
+                items.put(item)
+        except BaseException as err:
+            error = err
+        finally:
+            iterator.close()
+        items.put(_StageEnd(error))
+
+    thread = threading.Thread(target=profiler.wrap(name, run))
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            try:
+                item = items.get(timeout=tick)
+            except queue.Empty:
+                yield None
                 continue
+            if isinstance(item, _StageEnd):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+    finally:
+        # the consumer stopped early; take what the thread may be
+        # waiting to put, so it sees it's stopped
+        stopped.set()
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
 
-        try:
-            gh.push_github_issue(gh_issue, gh_comments, issue_id)
-        except:
-            abort.set()
+
+def _lookahead(iterator, fn, window):
+    """Yield ``(item, fn(item))`` for each item of the iterator, in order.
+
+    When window is nonzero, fn runs in a pool of threads for up to that
+    many items ahead of the one being yielded.
+
+    """
+    if not window:
+        for item in iterator:
+            yield item, fn(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(window) as executor:
+        yield from _in_order(
+            iterator, lambda item: executor.submit(fn, item), window)
+
+
+def _in_order(iterator, submit, window):
+    """Yield ``(item, result)`` for each item, in order.
+
+    submit(item) returns a future for the result; up to window futures
+    are kept pending ahead of the item being yielded.
+
+    """
+    pending = collections.deque()
+    for item in iterator:
+        pending.append((item, submit(item)))
+        if len(pending) > window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def push_issues(abort, work_queue, push, finish=None, errors=None):
+    """Push the issues from the work queue, until it gives None.
+
+    push(gh_issue, gh_comments, issue_id) is called for each issue, and
+    finish() at the end, if given.
+
+    An error sets abort, and is appended to errors, if given, for the
+    thread that started the push to raise; otherwise it's raised.
+
+    """
+    try:
+        for issue_id, gh_issue, gh_comments in iter(work_queue.get, None):
+            if not abort.is_set():
+                push(gh_issue, gh_comments, issue_id)
+        if finish is not None and not abort.is_set():
+            finish()
+    except:
+        abort.set()
+        # keep taking issues off the queue, so that the thread putting
+        # them there doesn't wait forever
+        for item in iter(work_queue.get, None):
+            pass
+        if errors is None:
             raise
-        finally:
-            work_queue.task_done()
+        errors.append(sys.exc_info()[1])
 
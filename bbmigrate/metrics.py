@@ -0,0 +1,299 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and histograms of what the migration is doing.
+
+Metrics are kept in a Registry, and can be served in the Prometheus text
+format with serve() or written to a JSON file periodically with
+JSONDumper.
+
+>>> registry = Registry()
+>>> calls = registry.counter("calls_total", "Calls made.")
+>>> calls.inc(service="github")
+>>> calls.inc(2, service="github")
+>>> print(registry.exposition(), end="")
+# HELP calls_total Calls made.
+# TYPE calls_total counter
+calls_total{service="github"} 3
+"""
+
+import http.server
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+# upper bounds of the buckets of histograms of durations, in seconds
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Return ``(labels, value)`` for each set of labels."""
+        with self._lock:
+            return [
+                (dict(labels), value)
+                for labels, value in sorted(self.values.items())
+            ]
+
+    def exposition(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for labels, value in self.samples():
+            lines.append(_sample(self.name, labels, value))
+        return lines
+
+    def as_json(self):
+        return {
+            "type": self.type,
+            "help": self.help,
+            "samples": [
+                {"labels": labels, "value": value}
+                for labels, value in self.samples()
+            ]
+        }
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that is set, or read from a callable when collected."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.fn is not None:
+            return [({}, self.fn())]
+        return super().samples()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0, 0))
+            counts = [
+                n + (value <= bound)
+                for n, bound in zip(counts, self.buckets)
+            ]
+            self.values[key] = counts, total + value, count + 1
+
+    def exposition(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for labels, (counts, total, count) in self.samples():
+            for bound, n in zip(self.buckets, counts):
+                lines.append(_sample(
+                    self.name + "_bucket", dict(labels, le=repr(bound)), n))
+            lines.append(_sample(
+                self.name + "_bucket", dict(labels, le="+Inf"), count))
+            lines.append(_sample(self.name + "_sum", labels, total))
+            lines.append(_sample(self.name + "_count", labels, count))
+        return lines
+
+    def as_json(self):
+        return {
+            "type": self.type,
+            "help": self.help,
+            "samples": [
+                {
+                    "labels": labels,
+                    "count": count,
+                    "sum": total,
+                    "buckets": list(zip(self.buckets, counts)),
+                }
+                for labels, (counts, total, count) in self.samples()
+            ]
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *arg, **kw):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *arg, **kw)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help, fn=None):
+        gauge = self._get(Gauge, name, help)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.extend(metric.exposition())
+        return "".join(line + "\n" for line in lines)
+
+    def as_json(self):
+        with self._lock:
+            metrics = sorted(self.metrics.items())
+        return {name: metric.as_json() for name, metric in metrics}
+
+    def http_hook(self, service):
+        """Return a ``requests`` response hook counting API calls."""
+
+        calls = self.counter(
+            "http_requests_total", "HTTP requests made, by endpoint.")
+        latency = self.histogram(
+            "http_request_seconds", "Time taken by HTTP requests.")
+
+        def hook(response, *args, **kw):
+            endpoint = endpoint_name(response.request.url)
+            calls.inc(
+                service=service, method=response.request.method,
+                endpoint=endpoint, status=response.status_code)
+            latency.observe(
+                response.elapsed.total_seconds(),
+                service=service, endpoint=endpoint)
+        return hook
+
+
+def endpoint_name(url):
+    """Return the path of a URL with the variable parts replaced.
+
+    >>> endpoint_name("https://api.github.com/repos/a/b/import/issues/12?x=1")
+    '/repos/a/b/import/issues/:id'
+    >>> endpoint_name("https://api.github.com/users/someone")
+    '/users/:name'
+    >>> endpoint_name("https://api.bitbucket.org/2.0/repositories/a/b/"
+    ...               "issues/5/attachments/crash%20dump.core")
+    '/2.0/repositories/a/b/issues/:id/attachments/:name'
+    """
+    path = urllib.parse.urlsplit(url).path
+    # users, attachments and labels are named freely, so there can be
+    # any number of them
+    path = re.sub(
+        r"/(users|attachments|labels)/[^/]+", r"/\1/:name", path)
+    return re.sub(r"/\d+(?=/|$)", "/:id", path)
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += "{{{}}}".format(",".join(
+            '{}="{}"'.format(key, str(label).replace('"', '\\"'))
+            for key, label in sorted(labels.items())
+        ))
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return "{} {}".format(name, value)
+
+
+def serve(registry, port, host=""):
+    """Serve the metrics over HTTP from a thread, and return the server."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload = registry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class JSONDumper:
+    """Writes the metrics to a JSON file every ``interval`` seconds."""
+
+    def __init__(self, registry, path, interval):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop dumping, after writing the metrics one last time."""
+        self._stop.set()
+        self._thread.join()
+        self.dump()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        data = {"time": time.time(), "metrics": self.registry.as_json()}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file_:
+            json.dump(data, file_, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
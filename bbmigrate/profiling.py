@@ -0,0 +1,220 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import cProfile
+import functools
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+# From Python 3.12 a cProfile sees every thread, and only one can be
+# active in a process at a time
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+
+class Profiler:
+    """Profiles each stage of the migration separately with cProfile.
+
+    A stage is profiled in the thread that runs it, either within the
+    stage() context manager or by calling a function returned by wrap().
+    Profiles are saved in ``directory`` as ``<stage>.prof``, which can be
+    loaded with pstats, and report() writes the ``top`` functions by
+    cumulative time of each stage to ``<stage>.txt`` and prints them.
+
+    When directory is None, nothing is profiled.
+
+    From Python 3.12, only one cProfile can be active in a process at a
+    time, and it sees every thread, so stages are profiled by sampling
+    the stack of their thread every ``interval`` seconds or so instead,
+    as they also are if another profiling tool is active.   Sampled
+    profiles are saved in the same format; their call counts are numbers
+    of samples, and their times are estimates.
+
+    """
+
+    def __init__(self, directory, top=20, interval=0.001):
+        self.directory = directory
+        self.top = top
+        self.stages = []
+        self._lock = threading.Lock()
+        self._sampler = _Sampler(interval)
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.directory is None:
+            yield
+            return
+
+        if PER_THREAD_CPROFILE:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as err:
+                # "Another profiling tool is already active"
+                print(
+                    "Sampling the {} stage instead: {}".format(name, err))
+            else:
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    profile.dump_stats(self._path(name, ".prof"))
+                    self._done(name)
+                return
+
+        ident = threading.get_ident()
+        stats = self._sampler.add(ident)
+        try:
+            yield
+        finally:
+            self._sampler.remove(ident)
+            with open(self._path(name, ".prof"), "wb") as file_:
+                marshal.dump(_pstats(stats), file_)
+            self._done(name)
+
+    def _done(self, name):
+        with self._lock:
+            self.stages.append(name)
+
+    def wrap(self, name, fn):
+        """Return fn, profiled as the stage name when called."""
+
+        @functools.wraps(fn)
+        def profiled(*arg, **kw):
+            with self.stage(name):
+                return fn(*arg, **kw)
+        return profiled
+
+    def report(self):
+        for name in self.stages:
+            out = io.StringIO()
+            stats = pstats.Stats(self._path(name, ".prof"), stream=out)
+            stats.sort_stats("cumulative").print_stats(self.top)
+            with open(self._path(name, ".txt"), "w") as file_:
+                file_.write(out.getvalue())
+            print("Profile of the {} stage:".format(name))
+            print(out.getvalue())
+
+    def _path(self, name, ext):
+        return os.path.join(self.directory, name + ext)
+
+
+class _Sampler:
+    """Samples the stacks of the threads added to it from a thread of its
+    own, which runs while there are any."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.threads = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, ident):
+        """Start sampling the thread ident, returning the dictionary its
+        samples are added to, see _sample()."""
+        stats = {}
+        with self._lock:
+            self.threads[ident] = stats
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+        return stats
+
+    def remove(self, ident):
+        with self._lock:
+            del self.threads[ident]
+
+    def _run(self):
+        last = time.perf_counter()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self.threads:
+                    self._thread = None
+                    return
+                # each sample stands for the time since the last one,
+                # which sleep() may well have overshot
+                now = time.perf_counter()
+                frames = sys._current_frames()
+                for ident, stats in self.threads.items():
+                    if ident in frames:
+                        _sample(stats, frames[ident], now - last)
+                del frames
+                last = now
+
+
+def _sample(stats, frame, elapsed):
+    """Add a sample of the stack of frame, standing for elapsed seconds,
+    to stats, which maps each
+    function to ``[samples, own time, cumulative time, callers]``, and
+    callers maps each calling function to ``[samples, cumulative time]``.
+
+    A function is counted once per sample, however deep it recurses.
+
+    """
+    seen = set()
+    callee = None
+    while frame is not None:
+        code = frame.f_code
+        func = (code.co_filename, code.co_firstlineno, code.co_name)
+        entry = stats.get(func)
+        if entry is None:
+            entry = stats[func] = [0, 0.0, 0.0, {}]
+        if callee is None:
+            entry[1] += elapsed
+        if func not in seen:
+            seen.add(func)
+            entry[0] += 1
+            entry[2] += elapsed
+        if callee is not None and callee != func:
+            edge = stats[callee][3].setdefault(func, [0, 0.0])
+            edge[0] += 1
+            edge[1] += elapsed
+        callee = func
+        frame = frame.f_back
+
+
+def _pstats(stats):
+    """Return the samples of _sample() as the statistics cProfile saves,
+    which pstats loads.
+
+    >>> def leaf():
+    ...     stats = {}
+    ...     _sample(stats, sys._getframe(), 0.5)
+    ...     return stats
+    >>> code = leaf.__code__
+    >>> func = (code.co_filename, code.co_firstlineno, code.co_name)
+    >>> _pstats(leaf())[func][:4]
+    (1, 1, 0.5, 0.5)
+    """
+    return {
+        func: (
+            samples, samples, own, cumulative,
+            {
+                caller: (calls, calls, 0.0, edge_time)
+                for caller, (calls, edge_time) in callers.items()
+            }
+        )
+        for func, (samples, own, cumulative, callers) in stats.items()
+    }
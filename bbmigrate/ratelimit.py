@@ -0,0 +1,194 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import email.utils
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket driven by GitHub's rate limit headers.
+
+    update() is meant to be a ``requests`` response hook; it only records
+    the ``X-RateLimit-*`` and ``Retry-After`` headers and never sleeps.
+    Callers instead call acquire() before sending a request, which blocks
+    until a token is available, or try_acquire() where blocking isn't an
+    option, such as in coroutines.   Tokens refill at the rate that spreads
+    the remaining calls, less ``reserve``, over the time left until the
+    limit resets, and up to ``burst`` of them can accumulate.
+
+    One RateLimiter can be shared by any number of threads.   The time
+    spent waiting is counted in ``metrics``, a metrics Registry, if given.
+
+    """
+
+    # how long to back off when GitHub's secondary ("abuse") rate
+    # limit kicks in without a Retry-After header
+    secondary_backoff = 60
+
+    def __init__(self, reserve=100, burst=10, metrics=None):
+        self.reserve = reserve
+        self.burst = burst
+        self.tokens = burst
+        self.rate = None
+        self.limit = self.remaining = self.reset = None
+        self.blocked_until = 0
+        self._last_refill = time.time()
+        self._last_report = 0
+        self._reported_block = None
+        self._cond = threading.Condition()
+        if metrics is not None:
+            self._wait_seconds = metrics.counter(
+                "ratelimit_wait_seconds_total",
+                "Time spent waiting for the GitHub rate limit.")
+        else:
+            self._wait_seconds = None
+
+    def acquire(self):
+        """Wait until a request may be sent, then take a token for it."""
+
+        started = None
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = self._take(now)
+                if wait is None:
+                    if started is not None:
+                        self.record_wait(now - started)
+                    return
+                if started is None:
+                    started = now
+                self._cond.wait(wait)
+
+    def try_acquire(self):
+        """Take a token if one is available and return None, otherwise
+        return how many seconds to wait before trying again.
+
+        This is for callers that can't block the thread, e.g. coroutines.
+
+        """
+        with self._cond:
+            return self._take(time.time())
+
+    def record_wait(self, seconds):
+        if self._wait_seconds is not None:
+            self._wait_seconds.inc(seconds)
+
+    def _take(self, now):
+        self._refill(now)
+        if now < self.blocked_until:
+            wait = self.blocked_until - now
+            if wait > 30 and self._reported_block != self.blocked_until:
+                self._reported_block = self.blocked_until
+                print(
+                    "WARNING!  GitHub rate limit reached; waiting "
+                    "{:.0f} seconds for it to reset...".format(wait))
+            return wait
+        elif self.rate is None or self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        else:
+            return (1 - self.tokens) / self.rate
+
+    def _refill(self, now):
+        if self.reset is not None and now >= self.reset:
+            # the limit has reset; run freely until a response tells
+            # us the new state
+            self.rate = self.reset = None
+            self.tokens = self.burst
+        elif self.rate is not None:
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self._last_refill) * self.rate
+            )
+        self._last_refill = now
+
+    def update(self, response, *args, **kw):
+        """Record the rate limit state from a response."""
+
+        headers = response.headers
+        now = time.time()
+        with self._cond:
+            self._refill(now)
+            if "X-RateLimit-Remaining" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+                self.reset = int(headers["X-RateLimit-Reset"])
+                self.rate = (
+                    max(self.remaining - self.reserve, 0) /
+                    max(self.reset - now, 1)
+                )
+                if self.remaining <= self.reserve:
+                    self.blocked_until = max(self.blocked_until, self.reset)
+
+            retry_after = _retry_after(headers.get("Retry-After"), now)
+            if retry_after is not None:
+                self.blocked_until = max(
+                    self.blocked_until, now + retry_after)
+            elif self.is_rate_limited(response):
+                self.blocked_until = max(
+                    self.blocked_until, now + self.secondary_backoff)
+
+            if self.rate is not None and now - self._last_report > 60:
+                self._last_report = now
+                print(
+                    "Refreshed github rate limit.  {} requests out "
+                    "of {} remaining, until {} seconds from now.   Will run "
+                    "API calls at {} requests per second".format(
+                        self.remaining, self.limit,
+                        self.reset - int(now), self.rate
+                    ))
+            self._cond.notify_all()
+
+    def is_rate_limited(self, response):
+        """Return True if the response was refused due to a rate limit."""
+
+        if response.status_code not in (403, 429):
+            return False
+        return (
+            "Retry-After" in response.headers or
+            response.headers.get("X-RateLimit-Remaining") == "0" or
+            "rate limit" in response.text.lower()
+        )
+
+
+def _retry_after(value, now):
+    """Return the seconds to wait from a ``Retry-After`` header, which is
+    either a number of seconds or an HTTP date, or None if there's no
+    header or it can't be parsed.
+
+    >>> _retry_after("120", 0)
+    120
+    >>> _retry_after("Thu, 01 Jan 1970 00:01:30 GMT", 60)
+    30.0
+    >>> _retry_after("soon", 0) is None
+    True
+    """
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        # "-0000"; HTTP dates are always GMT
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(date.timestamp() - now, 0)
@@ -0,0 +1,62 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Spool files of converted issues, ready to be pushed to GitHub.
+
+A spool is gzipped newline-delimited JSON, one
+``[issue_id, gh_issue, gh_comments]`` line per issue, in issue order.
+
+"""
+
+import gzip
+import json
+
+SUFFIX = ".ndjson.gz"
+
+
+def is_spool(path):
+    return path.endswith(SUFFIX)
+
+
+class SpoolWriter:
+    """Writes converted issues to a spool.
+
+    It takes the place of the queue of issues to push, so put() accepts
+    the same ``(issue_id, gh_issue, gh_comments)`` tuples.
+
+    """
+
+    def __init__(self, path):
+        if not is_spool(path):
+            raise TypeError(
+                "Spool file name must end with {}: {}".format(SUFFIX, path))
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+
+    def put(self, item):
+        self.file.write(json.dumps(item, sort_keys=True) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def read(path, offset):
+    """Yield the issues of a spool with an id above offset."""
+
+    with gzip.open(path, "rt", encoding="utf-8") as file_:
+        for line in file_:
+            issue_id, gh_issue, gh_comments = json.loads(line)
+            if issue_id > offset:
+                yield issue_id, gh_issue, gh_comments
@@ -0,0 +1,388 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for the parts of the GitHub API the migration uses.
+
+The repository, labels, milestones, users, issue import endpoints and the
+issue endpoints used by --delta are imitated in memory, so that pushing
+issues can be tried out and load tested without GitHub.   Run it as::
+
+    python -m bbmigrate.standin --port 8000 --pending 2 --jitter 1
+
+and migrate with ``--github-api-url http://127.0.0.1:8000``; any password
+is accepted.
+
+Imports stay pending for ``pending`` seconds plus a random amount up to
+``jitter``, and get their issue numbers in the order they finish, so with
+a jitter they can finish out of order just like on GitHub.   Requests
+are counted against a rate limit of ``rate_limit`` per ``rate_window``
+seconds, reported in the usual headers.   ``faults`` maps an HTTP status
+to the fraction of import and import status requests that fail with it.
+
+"""
+
+import argparse
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+
+class StandIn:
+    def __init__(
+            self, repo="standin/repo", latency=0, pending=0.5, jitter=0,
+            rate_limit=5000, rate_window=3600, faults=None, users=None,
+            seed=None):
+        self.repo = repo
+        self.latency = latency
+        self.pending = pending
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.faults = faults or {}
+        self.users = users
+        self.random = random.Random(seed)
+        self.url = None
+
+        self.labels = []
+        self.milestones = []
+        self.issues = []
+        self.imports = []
+        self._window_start = time.time()
+        self._calls = 0
+        self._lock = threading.Lock()
+
+        repo_path = "/repos/" + re.escape(repo)
+        self.routes = [
+            ("GET", repo_path, self._get_repo),
+            ("GET", repo_path + "/issues", self._get_issues),
+            ("PATCH", repo_path + r"/issues/(\d+)", self._edit_issue),
+            ("POST", repo_path + r"/issues/(\d+)/comments",
+             self._add_comment),
+            ("GET", repo_path + "/labels", self._get_labels),
+            ("POST", repo_path + "/labels", self._create_label),
+            ("GET", repo_path + "/milestones", self._get_milestones),
+            ("POST", repo_path + "/milestones", self._create_milestone),
+            ("POST", repo_path + "/import/issues", self._import_issue),
+            ("GET", repo_path + r"/import/issues/(\d+)",
+             self._get_import),
+            ("GET", r"/users/([^/]+)", self._get_user),
+        ]
+
+    def handle(self, method, url, body):
+        """Return ``(status, headers, data)`` for a request."""
+
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urllib.parse.urlsplit(url)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+
+        with self._lock:
+            now = time.time()
+            self._complete_imports(now)
+            headers = self._count_call(now)
+            if self._calls > self.rate_limit:
+                return 403, headers, {
+                    "message": "API rate limit exceeded for user."}
+
+            for route_method, pattern, fn in self.routes:
+                match = re.fullmatch(pattern, parsed.path)
+                if match and route_method == method:
+                    # routes can give headers of their own after the data
+                    status, data, *more_headers = fn(
+                        query, body, *match.groups())
+                    for more in more_headers:
+                        headers.update(more)
+                    return status, headers, data
+        return 404, headers, {"message": "Not Found"}
+
+    def _count_call(self, now):
+        if now >= self._window_start + self.rate_window:
+            self._window_start = now
+            self._calls = 0
+        self._calls += 1
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(
+                max(self.rate_limit - self._calls, 0)),
+            "X-RateLimit-Reset": str(
+                int(self._window_start + self.rate_window)),
+        }
+
+    def _fault(self):
+        for status, rate in self.faults.items():
+            if self.random.random() < rate:
+                return status, {"message": "Injected failure"}
+        return None
+
+    def _complete_imports(self, now):
+        # imports finish in the background on GitHub, so numbers are
+        # given out in the order they're done rather than when polled
+        done = sorted(
+            (imp for imp in self.imports
+             if imp["status"] == "pending" and imp["ready_at"] <= now),
+            key=lambda imp: imp["ready_at"]
+        )
+        for imp in done:
+            issue = imp["issue"]
+            number = len(self.issues) + 1
+            self.issues.append({
+                "number": number,
+                "title": issue["title"],
+                "state": "closed" if issue.get("closed") else "open",
+                "labels": [
+                    {"name": label} for label in issue.get("labels", [])],
+                "comments": len(imp["comments"]),
+            })
+            imp["status"] = "imported"
+            imp["issue_url"] = "{}/repos/{}/issues/{}".format(
+                self.url, self.repo, number)
+
+    def _get_repo(self, query, body):
+        return 200, {"full_name": self.repo}
+
+    def _get_issues(self, query, body):
+        issues = sorted(
+            self.issues, key=lambda issue: issue["number"],
+            reverse=query.get("direction", "desc") == "desc")
+        state = query.get("state", "open")
+        if state != "all":
+            issues = [issue for issue in issues if issue["state"] == state]
+        per_page = min(int(query.get("per_page", 30)), 100)
+        page = int(query.get("page", 1))
+        last_page = max((len(issues) + per_page - 1) // per_page, 1)
+        links = [
+            '<{}/repos/{}/issues?{}>; rel="{}"'.format(
+                self.url, self.repo,
+                urllib.parse.urlencode(dict(query, page=number)), rel)
+            for number, rel in [(page + 1, "next"), (last_page, "last")]
+            if page < last_page
+        ]
+        headers = {"Link": ", ".join(links)} if links else {}
+        return 200, issues[(page - 1) * per_page:page * per_page], headers
+
+    def _issue(self, number):
+        number = int(number)
+        if not 0 < number <= len(self.issues):
+            return None
+        return self.issues[number - 1]
+
+    def _edit_issue(self, query, body, number):
+        issue = self._issue(number)
+        if issue is None:
+            return 404, {"message": "Not Found"}
+        for key in ("title", "state"):
+            if key in body:
+                issue[key] = body[key]
+        if "labels" in body:
+            issue["labels"] = [{"name": label} for label in body["labels"]]
+        return 200, issue
+
+    def _add_comment(self, query, body, number):
+        issue = self._issue(number)
+        if issue is None:
+            return 404, {"message": "Not Found"}
+        issue["comments"] += 1
+        return 201, {"body": body["body"]}
+
+    def _get_labels(self, query, body):
+        return 200, self.labels
+
+    def _create_label(self, query, body):
+        self.labels.append({"name": body["name"], "color": body["color"]})
+        return 201, self.labels[-1]
+
+    def _get_milestones(self, query, body):
+        return 200, self.milestones
+
+    def _create_milestone(self, query, body):
+        self.milestones.append({
+            "title": body["title"], "number": len(self.milestones) + 1})
+        return 201, self.milestones[-1]
+
+    def _import_issue(self, query, body):
+        fault = self._fault()
+        if fault:
+            return fault
+        if not body.get("issue", {}).get("title"):
+            return 422, {"errors": [
+                {"resource": "Issue", "field": "title",
+                 "code": "missing_field"}]}
+        import_id = len(self.imports) + 1
+        self.imports.append({
+            "id": import_id,
+            "status": "pending",
+            "ready_at": (
+                time.time() + self.pending +
+                self.random.uniform(0, self.jitter)),
+            "issue": body["issue"],
+            "comments": body.get("comments", []),
+        })
+        return 202, self._import_status(self.imports[-1])
+
+    def _get_import(self, query, body, import_id):
+        fault = self._fault()
+        if fault:
+            return fault
+        import_id = int(import_id)
+        if not 0 < import_id <= len(self.imports):
+            return 404, {"message": "Not Found"}
+        return 200, self._import_status(self.imports[import_id - 1])
+
+    def _import_status(self, imp):
+        status = {
+            "id": imp["id"],
+            "status": imp["status"],
+            "url": "{}/repos/{}/import/issues/{}".format(
+                self.url, self.repo, imp["id"]),
+        }
+        if imp["status"] == "imported":
+            status["issue_url"] = imp["issue_url"]
+        return status
+
+    def _get_user(self, query, body, username):
+        if self.users is not None and username not in self.users:
+            return 404, {"message": "Not Found"}
+        return 200, {"login": username}
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Start serving in a thread and return the server."""
+
+        server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+        server.standin = self
+        self.url = "http://{}:{}".format(*server.server_address[:2])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, method, send_body=True):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        status, headers, data = self.server.standin.handle(
+            method, self.path, body)
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(payload)
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_HEAD(self):
+        self._respond("GET", send_body=False)
+
+    def do_POST(self):
+        self._respond("POST")
+
+    def do_PATCH(self):
+        self._respond("PATCH")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _fault(text):
+    status, _, rate = text.partition("=")
+    return int(status), float(rate)
+
+
+def _read_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in for the GitHub API."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--repo", default="standin/repo",
+        help="Name of the repository.  Defaults to standin/repo."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0,
+        help="Seconds taken to answer every request."
+    )
+    parser.add_argument(
+        "--pending", type=float, default=0.5,
+        help="Seconds an import stays pending.  Defaults to 0.5."
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0,
+        help=(
+            "Up to this many more seconds an import stays pending, picked "
+            "at random, so that imports can finish out of order."
+        )
+    )
+    parser.add_argument(
+        "--rate-limit", type=int, default=5000,
+        help="Requests allowed per rate limit window.  Defaults to 5000."
+    )
+    parser.add_argument(
+        "--rate-window", type=float, default=3600,
+        help="Seconds of the rate limit window.  Defaults to 3600."
+    )
+    parser.add_argument(
+        "--fault", type=_fault, action="append", default=[],
+        metavar="STATUS=RATE",
+        help=(
+            "Fail this fraction of the import and import status requests "
+            "with the HTTP status, e.g. 404=0.05.  Can be specified "
+            "multiple times."
+        )
+    )
+    parser.add_argument(
+        "--user", action="append", dest="users",
+        help=(
+            "GitHub user that exists; any other user name is not found. "
+            "Can be specified multiple times.  By default all users exist."
+        )
+    )
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = _read_arguments(argv)
+    standin = StandIn(
+        repo=options.repo, latency=options.latency, pending=options.pending,
+        jitter=options.jitter, rate_limit=options.rate_limit,
+        rate_window=options.rate_window, faults=dict(options.fault),
+        users=set(options.users) if options.users else None,
+        seed=options.seed)
+    server = standin.serve(options.host, options.port)
+    print("Serving a GitHub stand-in for {} at {}".format(
+        options.repo, standin.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
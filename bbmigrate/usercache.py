@@ -0,0 +1,78 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sqlite3
+import threading
+import time
+
+
+class UserCache:
+    """Persistent cache of user lookups, shared across runs.
+
+    Bitbucket display names and GitHub user existence checks are stored
+    in a small SQLite file, so that restarting a migration doesn't need
+    to repeat them.   Lookups that found nothing ("negative" entries) are
+    kept for ``negative_ttl`` seconds, everything else for ``ttl`` seconds.
+
+    >>> cache = UserCache(":memory:", ttl=60, negative_ttl=0)
+    >>> cache.set("github", "someone", "someone")
+    >>> cache.set("github", "nobody", None, negative=True)
+    >>> cache.lookup("github", "someone")
+    'someone'
+    >>> cache.lookup("github", "nobody")
+    Traceback (most recent call last):
+    ...
+    KeyError: ('github', 'nobody')
+    """
+
+    def __init__(self, path, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "namespace TEXT, name TEXT, value TEXT, negative INTEGER, "
+            "stored REAL, PRIMARY KEY (namespace, name))"
+        )
+        self.conn.commit()
+
+    def lookup(self, namespace, name):
+        """Return the cached value, raising KeyError if absent or expired."""
+
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value, negative, stored FROM users "
+                "WHERE namespace = ? AND name = ?",
+                (namespace, name)
+            ).fetchone()
+        if row is None:
+            raise KeyError((namespace, name))
+        value, negative, stored = row
+        ttl = self.negative_ttl if negative else self.ttl
+        if time.time() - stored > ttl:
+            raise KeyError((namespace, name))
+        return json.loads(value)
+
+    def set(self, namespace, name, value, negative=False):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)",
+                (namespace, name, json.dumps(value), int(negative),
+                 time.time())
+            )
+            self.conn.commit()
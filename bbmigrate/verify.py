@@ -0,0 +1,119 @@
+# This file is part of the Bitbucket issue migration script.
+#
+# The script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Bitbucket issue migration script.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+
+from . import aio
+
+
+class Verifier:
+    """Compares the issues of the GitHub repository with the converted
+    issues of the source, for --verify.
+
+    The issues of the repository are fetched in the background as soon
+    as the Verifier is created, ``workers`` pages at a time, while the
+    source is read and converted just as for a migration; check_issue()
+    then takes the place of pushing each issue.
+
+    """
+
+    def __init__(self, gh, options, workers):
+        self.gh = gh
+        self.checked = 0
+        self.mismatched = 0
+        if options.aio:
+            self._github_issues = options.aio.submit(self._fetch_async(
+                aio.AsyncGitHub(gh, options.aio), workers))
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+            self._github_issues = executor.submit(self._fetch, workers)
+            executor.shutdown(wait=False)
+
+    def _fetch(self, workers):
+        return {
+            issue['number']: _summary(issue)
+            for issue in self.gh.get_all_issues(workers)
+        }
+
+    async def _fetch_async(self, async_gh, workers):
+        issues = {}
+        async for issue in async_gh.get_all_issues(workers):
+            issues[issue['number']] = _summary(issue)
+        return issues
+
+    def check_issue(self, issue, comments, issue_id):
+        github_issues = self._github_issues.result()
+        problems = _compare(issue, comments, github_issues.pop(issue_id, None))
+        self.checked += 1
+        if problems:
+            self.mismatched += 1
+            print("Issue {} doesn't match: {}".format(
+                issue_id, "; ".join(problems)))
+
+    def finish(self):
+        extra = sorted(self._github_issues.result())
+        if extra:
+            print("{} issues on GitHub aren't in the source: {}{}".format(
+                len(extra), ", ".join(str(number) for number in extra[:20]),
+                ", ..." if len(extra) > 20 else ""))
+        print("Verified {} issues against {}, {} don't match".format(
+            self.checked, self.gh.repo, self.mismatched))
+
+
+def _summary(issue):
+    """Keep only what is compared of an issue from GitHub."""
+    return {
+        'title': issue['title'],
+        'state': issue['state'],
+        'comments': issue['comments'],
+        'labels': [label['name'] for label in issue['labels']],
+        'pull_request': 'pull_request' in issue,
+    }
+
+
+def _compare(issue, comments, github_issue):
+    """Return the differences between a converted issue and the GitHub
+    issue, if any.
+
+    >>> issue = {'title': 'Crash', 'closed': True, 'labels': ['bug']}
+    >>> _compare(issue, [{'body': 'same here'}], {
+    ...     'title': 'Crash', 'state': 'open', 'comments': 1,
+    ...     'labels': ['bug'], 'pull_request': False})
+    ['state is open rather than closed']
+    >>> _compare(issue, [], None)
+    ['missing on GitHub']
+    """
+    if github_issue is None:
+        return ['missing on GitHub']
+
+    problems = []
+    if github_issue['pull_request']:
+        problems.append('is a pull request on GitHub')
+    if github_issue['title'] != issue['title']:
+        problems.append('title is {!r} rather than {!r}'.format(
+            github_issue['title'], issue['title']))
+    state = 'closed' if issue.get('closed') else 'open'
+    if github_issue['state'] != state:
+        problems.append('state is {} rather than {}'.format(
+            github_issue['state'], state))
+    if github_issue['comments'] != len(comments):
+        problems.append('has {} comments rather than {}'.format(
+            github_issue['comments'], len(comments)))
+    labels = sorted(issue.get('labels', ()))
+    if sorted(github_issue['labels']) != labels:
+        problems.append('labels are {} rather than {}'.format(
+            sorted(github_issue['labels']), labels))
+    return problems
@@ -19,6 +19,9 @@ setup(name='bbmigrate',
       packages=["bbmigrate"],
       zip_safe=False,
       install_requires=requirements,
+      extras_require={
+          'asyncio': ['aiohttp'],
+      },
       entry_points={
           'console_scripts': [
               'bbmigrate = bbmigrate.main:main',